@@ -0,0 +1,108 @@
+import threading
+from collections import OrderedDict
+from ratelimit import *
+
+# Results of AdmissionControl.admit()
+ADMITTED = "admitted"
+RATE_LIMITED = "rate limited"
+BUSY = "busy"
+
+class AdmissionControl():
+    """
+    AdmissionControl decides whether a parsed request is handled. Every
+    user has a token bucket, and all users share a global one, a request
+    takes as many tokens as the cost of its responder from both. It also
+    counts the requests that are admitted but not finished, and sheds new
+    requests when there are max_pending of them.
+    """
+    def __init__(self, user_rate=0.5, user_burst=5, global_rate=10,
+                 global_burst=30, max_pending=100, max_users=10000):
+        """
+        Param: user_rate: Tokens a user gains per second
+        Param: user_burst: Max tokens of a user
+        Param: global_rate: Tokens all users gain per second
+        Param: global_burst: Max tokens of all users
+        Param: max_pending: Max number of requests admitted but not finished
+        Param: max_users: Max number of user buckets kept, the least recent
+            users are forgotten first
+        """
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.max_pending = max_pending
+        self.max_users = max_users
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()    # puid:TokenBucket
+        # puid:the result the user was last told, RATE_LIMITED or BUSY
+        self.notified = {}
+        self.pending = 0
+        self.counters = {ADMITTED: 0, RATE_LIMITED: 0, BUSY: 0}
+
+    def admit(self, puid, cost=1):
+        """
+        Return (result, notify). result is ADMITTED, RATE_LIMITED or BUSY.
+        notify is True if the user should be told about it, a user is only
+        told once about the same result until a request is admitted again,
+        so flooding the bot does not make it send more messages.
+        If admitted, finish() must be called when the request is done
+        """
+        if cost <= 0:
+            with self.lock:
+                self.pending += 1
+                self.counters[ADMITTED] += 1
+            return ADMITTED, False
+        bucket = self._bucket(puid)
+        if not bucket.try_acquire(cost):
+            with self.lock:
+                self.counters[RATE_LIMITED] += 1
+                notify = self._notify(puid, RATE_LIMITED)
+            return RATE_LIMITED, notify
+        with self.lock:
+            busy = self.pending >= self.max_pending
+            if not busy:
+                self.pending += 1
+        if busy or not self.global_bucket.try_acquire(cost):
+            if not busy:
+                self.finish()
+            bucket.refund(cost)
+            with self.lock:
+                self.counters[BUSY] += 1
+                notify = self._notify(puid, BUSY)
+            return BUSY, notify
+        with self.lock:
+            self.counters[ADMITTED] += 1
+            self.notified.pop(puid, None)
+        return ADMITTED, False
+
+    def finish(self):
+        "Call when an admitted request is done"
+        with self.lock:
+            self.pending -= 1
+
+    def stats(self):
+        "Return the counters in dict"
+        with self.lock:
+            stats = dict(self.counters)
+            stats["pending"] = self.pending
+            return stats
+
+    def _notify(self, puid, result):
+        "Return True if the user was not told about result, must hold lock"
+        if self.notified.get(puid) == result:
+            return False
+        self.notified[puid] = result
+        return True
+
+    def _bucket(self, puid):
+        "Return the bucket of the user"
+        with self.lock:
+            bucket = self.buckets.get(puid)
+            if bucket is None:
+                bucket = self.buckets[puid] = TokenBucket(self.user_rate,
+                                                          self.user_burst)
+                if len(self.buckets) > self.max_users:
+                    old, _ = self.buckets.popitem(last=False)
+                    self.notified.pop(old, None)
+            else:
+                self.buckets.move_to_end(puid)
+            return bucket
@@ -0,0 +1,296 @@
+import bisect
+import sqlite3
+import threading
+import time
+from logger import *
+
+class Watch():
+    "A stock watch of a user, alert when the price goes above or below"
+    def __init__(self, id, puid, symbol, op, price):
+        """
+        Param: id: The unique id of the watch
+        Param: puid: The user who watches
+        Param: symbol: The stock symbol in upper case
+        Param: op: "above" or "below"
+        Param: price: The threshold price
+        """
+        self.id = id
+        self.puid = puid
+        self.symbol = symbol
+        self.op = op
+        self.price = price
+
+    def __repr__(self):
+        return str(self.id) + ": " + self.symbol + " " + self.op + " " +\
+                str(self.price)
+
+
+class WatchStore():
+    "Keeps the watches in a SQLite database, so they survive restarts"
+    def __init__(self, path="resources/watches.db"):
+        "Param: path: The path of the SQLite database file"
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS watches ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "puid TEXT NOT NULL, "
+                "symbol TEXT NOT NULL, "
+                "op TEXT NOT NULL, "
+                "price REAL NOT NULL)")
+
+    def add(self, puid, symbol, op, price):
+        "Save the watch, return the Watch with its id"
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO watches (puid, symbol, op, price) "
+                "VALUES (?, ?, ?, ?)", (puid, symbol, op, price))
+        return Watch(cursor.lastrowid, puid, symbol, op, price)
+
+    def delete(self, ids):
+        "Delete the watches with the ids"
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM watches WHERE id = ?",
+                                  [(id,) for id in ids])
+
+    def all(self):
+        "Return all the watches"
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, puid, symbol, op, price FROM watches").fetchall()
+        return [Watch(*row) for row in rows]
+
+
+class AlertScheduler():
+    """
+    AlertScheduler checks the stock watches of all users in background.
+    Watches are grouped by symbol, and every cycle retrieves the price of
+    each symbol once, no matter how many users watch it. The thresholds
+    of a symbol are kept sorted, so the watches a price triggers are found
+    by binary search. A watch is removed after its alert is sent, and is
+    checked again next cycle if the alert could not be sent. The
+    watches of a symbol that has no price max_misses polls in a row are
+    removed, and their users are told.
+    """
+    def __init__(self, store_factory=WatchStore, max_per_user=20,
+                 max_misses=3):
+        """
+        Param: store_factory: Function that returns the WatchStore, it is
+            called on first use
+        Param: max_per_user: Max number of watches of one user
+        Param: max_misses: Polls in a row a symbol can have no price before
+            its watches are removed
+        """
+        self.store_factory = store_factory
+        self.max_per_user = max_per_user
+        self.max_misses = max_misses
+        self.misses = {}    # symbol:polls in a row without a price
+        self.lock = threading.RLock()
+        self.store = None
+        self.watches = {}   # id:Watch
+        # symbol:{"above": sorted [(price, id)], "below": sorted [(price, id)]}
+        self.symbols = {}
+        self.thread = None
+        self.polls = 0
+        self.alerts = 0
+        self.dropped = 0
+        self.logger = Logger("AlertScheduler")
+
+    def add(self, puid, symbol, op, price):
+        """
+        Add a watch, op is "above" or "below". Return the Watch, None if
+        the user has too many watches
+        """
+        with self.lock:
+            self._load()
+            if len(self.list(puid)) >= self.max_per_user:
+                return None
+            watch = self.store.add(puid, symbol.upper(), op, price)
+            self._index(watch)
+        return watch
+
+    def remove(self, puid, id):
+        "Remove the watch of the user, return True if removed"
+        with self.lock:
+            self._load()
+            watch = self.watches.get(id)
+            if watch is None or watch.puid != puid:
+                return False
+            self._unindex([watch])
+        self.store.delete([id])
+        return True
+
+    def remove_all(self, puid):
+        "Remove all the watches of the user, return the number removed"
+        with self.lock:
+            self._load()
+            watches = [w for w in self.watches.values() if w.puid == puid]
+            self._unindex(watches)
+        self.store.delete([w.id for w in watches])
+        return len(watches)
+
+    def list(self, puid):
+        "Return the watches of the user, sorted by id"
+        with self.lock:
+            self._load()
+            return sorted((w for w in self.watches.values() if w.puid == puid),
+                          key=lambda w: w.id)
+
+    def check(self, symbol, price):
+        """
+        Remove and return the watches of symbol that price triggers, above
+        watches with threshold at most price, below watches with threshold
+        at least price. They are only removed from the groups, call done()
+        with them once their alerts are sent, or restore() if not
+        """
+        with self.lock:
+            self._load()
+            group = self.symbols.get(symbol)
+            if group is None:
+                return []
+            above = group["above"]
+            below = group["below"]
+            # (price, inf) sorts after every (price, id)
+            hit = above[:bisect.bisect_right(above, (price, float("inf")))]
+            hit += below[bisect.bisect_left(below, (price, -1)):]
+            triggered = [self.watches[id] for _, id in hit]
+            self._unindex(triggered)
+        return triggered
+
+    def done(self, watches):
+        "Delete the watches returned by check() from the store"
+        if watches:
+            self.store.delete([w.id for w in watches])
+
+    def restore(self, watches):
+        "Put the watches returned by check() back, to be checked again"
+        with self.lock:
+            for watch in watches:
+                self._index(watch)
+
+    def poll(self, fetch, send):
+        """
+        Run one cycle, retrieve the price of every watched symbol with fetch
+        and send the alerts with send. Return the number of alerts sent
+        Param: fetch: Function that takes a symbol and returns (date, price),
+            or None if there is no price
+        Param: send: Function that takes (puid, message) and sends it
+        """
+        with self.lock:
+            self._load()
+            symbols = list(self.symbols)
+        sent = 0
+        for symbol in symbols:
+            try:
+                latest = fetch(symbol)
+            except Exception as e:
+                self.logger.warning("Failed to retrieve %s: %r", symbol, e)
+                continue
+            with self.lock:
+                self.polls += 1
+            if latest is None:
+                self._missed(symbol, send)
+                continue
+            with self.lock:
+                self.misses.pop(symbol, None)
+            date, price = latest
+            alerted = []
+            failed = []
+            for watch in self.check(symbol, price):
+                message = "Stock alert: " + symbol + " is " + str(price) +\
+                        " on " + date + ", " + watch.op + " " +\
+                        str(watch.price)
+                try:
+                    send(watch.puid, message)
+                    alerted.append(watch)
+                except Exception as e:
+                    self.logger.warning("Failed to send alert %d: %r",
+                                        watch.id, e)
+                    failed.append(watch)
+            self.done(alerted)
+            self.restore(failed)
+            sent += len(alerted)
+        with self.lock:
+            self.alerts += sent
+        return sent
+
+    def start(self, fetch, send, interval=300):
+        "Run poll every interval seconds in background, see poll()"
+        if self.thread is not None:
+            return
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.poll(fetch, send)
+                except Exception as e:
+                    self.logger.error("Failed to poll watches: %r", e)
+        self.thread = threading.Thread(target=loop, daemon=True,
+                                       name="AlertScheduler")
+        self.thread.start()
+
+    def stats(self):
+        "Return the counters in dict"
+        with self.lock:
+            return {
+                "watches": len(self.watches),
+                "symbols": len(self.symbols),
+                "polls": self.polls,
+                "alerts": self.alerts,
+                "dropped": self.dropped,
+            }
+
+    def _missed(self, symbol, send):
+        """
+        Count a poll of symbol without a price, remove its watches and tell
+        their users if it has no price max_misses polls in a row
+        """
+        with self.lock:
+            misses = self.misses.get(symbol, 0) + 1
+            self.misses[symbol] = misses
+            if misses < self.max_misses:
+                return
+            del self.misses[symbol]
+            watches = [w for w in self.watches.values() if w.symbol == symbol]
+            self._unindex(watches)
+            self.dropped += len(watches)
+        self.store.delete([w.id for w in watches])
+        self.logger.warning("Removed %d watches of %s, it has no price",
+                            len(watches), symbol)
+        for watch in watches:
+            try:
+                send(watch.puid, "Stock watch removed: " + str(watch) +
+                     ", no price was found for " + symbol)
+            except Exception as e:
+                self.logger.warning("Failed to send notice of watch %d: %r",
+                                    watch.id, e)
+
+    def _load(self):
+        "Open the store and read the watches on first use, must hold lock"
+        if self.store is not None:
+            return
+        self.store = self.store_factory()
+        for watch in self.store.all():
+            self._index(watch)
+        self.logger.log("Loaded %d watches", len(self.watches))
+
+    def _index(self, watch):
+        "Add the watch to the groups, must hold lock"
+        self.watches[watch.id] = watch
+        group = self.symbols.setdefault(watch.symbol,
+                                        {"above": [], "below": []})
+        bisect.insort(group[watch.op], (watch.price, watch.id))
+
+    def _unindex(self, watches):
+        "Remove the watches from the groups, must hold lock"
+        for watch in watches:
+            del self.watches[watch.id]
+            group = self.symbols[watch.symbol]
+            group[watch.op].remove((watch.price, watch.id))
+            if not group["above"] and not group["below"]:
+                del self.symbols[watch.symbol]
+
+
+# The stock watches of all users
+stock_alerts = AlertScheduler()
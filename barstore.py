@@ -0,0 +1,137 @@
+import os
+import re
+import threading
+from logger import *
+
+class Bars():
+    """
+    Daily bars of one symbol in columns, every column is a numpy array with
+    one value per trading day, sorted by date
+    Var: date: Dates in numpy datetime64[D]
+    Var: open, high, low, close: Prices in float64
+    Var: volume: Volumes in int64
+    """
+    def __init__(self, symbol, columns):
+        """
+        Param: symbol: The stock symbol
+        Param: columns: Dict of column name:numpy array
+        """
+        self.symbol = symbol
+        self.columns = columns
+        for name, values in columns.items():
+            setattr(self, name, values)
+
+    def between(self, start, end):
+        """
+        Return the Bars from date start to end, both included, dates are
+        str in format yyyy-mm-dd. Found by binary search on the dates
+        """
+        first = self.date.searchsorted(self.date.dtype.type(start), "left")
+        last = self.date.searchsorted(self.date.dtype.type(end), "right")
+        return Bars(self.symbol, {name: values[first:last]
+                                  for name, values in self.columns.items()})
+
+    def __len__(self):
+        return len(self.date)
+
+
+class BarStore():
+    """
+    BarStore keeps the daily bars of every symbol on disk. Each column of
+    a symbol is a raw binary file that is opened as a read only numpy
+    memory map, so loading a symbol does not read its whole history, and
+    new days are appended to the end of the files, the days stored before
+    are never written again. The date file is appended last, its length is
+    the number of complete days, so a crash while appending only leaves
+    extra values in the other files, which are cut off by the next append.
+    numpy is imported when the store is created, ImportError is raised if
+    it is not installed.
+    """
+    # Column name:(numpy dtype, key in the alphavantage daily series)
+    columns = {
+        "open": ("<f8", "1. open"),
+        "high": ("<f8", "2. high"),
+        "low": ("<f8", "3. low"),
+        "close": ("<f8", "4. close"),
+        "volume": ("<i8", "5. volume"),
+        "date": ("<M8[D]", None),
+    }
+
+    def __init__(self, path="resources/bars"):
+        "Param: path: The folder of the bar files"
+        import numpy
+        self.np = numpy
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded = {}    # symbol:Bars, dropped when new days are added
+        self.logger = Logger("BarStore")
+
+    def load(self, symbol):
+        "Return the Bars of the symbol, empty if there is none"
+        symbol = symbol.upper()
+        with self.lock:
+            bars = self.loaded.get(symbol)
+            if bars is None:
+                bars = self.loaded[symbol] = self._open(symbol)
+            return bars
+
+    def update(self, symbol, series):
+        """
+        Add the days in series that are newer than the last stored day,
+        series is the 'Time Series (Daily)' dict of alphavantage. Return
+        the number of days added
+        """
+        symbol = symbol.upper()
+        with self.lock:
+            bars = self.loaded.get(symbol) or self._open(symbol)
+            last = str(bars.date[-1]) if len(bars) > 0 else ""
+            # Dates in yyyy-mm-dd sort the same as strings
+            days = sorted(day for day in series if day > last)
+            if not days:
+                self.loaded[symbol] = bars
+                return 0
+            folder = self._folder(symbol)
+            os.makedirs(folder, exist_ok=True)
+            count = len(bars)
+            for name, (dtype, key) in self.columns.items():
+                if key is None:
+                    values = self.np.array(days, dtype=dtype)
+                else:
+                    values = self.np.array([float(series[day][key])
+                                            for day in days]).astype(dtype)
+                path = os.path.join(folder, name)
+                with open(path, "ab") as f:
+                    # Cut off the values left by an append that crashed
+                    f.truncate(count * self.np.dtype(dtype).itemsize)
+                    f.write(values.tobytes())
+            self.loaded.pop(symbol, None)
+        self.logger.debug("Added %d days of %s", len(days), symbol)
+        return len(days)
+
+    def _open(self, symbol):
+        "Open the column files of the symbol as memory maps, must hold lock"
+        folder = self._folder(symbol)
+        count = self._count(folder)
+        columns = {}
+        for name, (dtype, _) in self.columns.items():
+            if count == 0:
+                columns[name] = self.np.empty(0, dtype=dtype)
+            else:
+                columns[name] = self.np.memmap(os.path.join(folder, name),
+                                               dtype=dtype, mode="r",
+                                               shape=(count,))
+        return Bars(symbol, columns)
+
+    def _count(self, folder):
+        "Return the number of complete days in the folder"
+        try:
+            size = os.path.getsize(os.path.join(folder, "date"))
+        except OSError:
+            return 0
+        return size // self.np.dtype(self.columns["date"][0]).itemsize
+
+    def _folder(self, symbol):
+        "Return the folder of the symbol, raise ValueError if it is invalid"
+        if re.fullmatch("[A-Z0-9][A-Z0-9.-]*", symbol) is None:
+            raise ValueError("Invalid stock symbol: " + symbol)
+        return os.path.join(self.path, symbol)
@@ -0,0 +1,145 @@
+"""
+Load test of wechatbot on a SimulatedTransport. Messages from many
+simulated users are injected at a fixed rate, and go through the same
+routing, admission, responders and send path as messages from Wechat,
+with the responders talking to local stub servers. It reports the rate
+the messages were received at, how many requests the admission control
+admitted and turned away, and the rate and latency of the admitted
+requests. Busy and rate limited replies are counted apart, as they are
+sent at once and would hide how long real requests take.
+
+Usage: python bench/load.py [corpus] [--count N] [--rate N] [--users N]
+       [--delay SECONDS] [--workers N] [--max-pending N] [--rate-limit]
+       [--json PATH]
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from replay import *
+from admission import *
+from transport import SimulatedTransport
+
+class AdmittedExecutor():
+    """
+    Wrap the executor of wechatbot to know which messages were admitted,
+    and when their requests finished, the reply included
+    """
+    def __init__(self, executor):
+        self.executor = executor
+
+    def submit(self, fn, msg, *args):
+        msg.admitted = True
+        def run():
+            try:
+                fn(msg, *args)
+            finally:
+                msg.finished = time.perf_counter()
+        return self.executor.submit(run)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+def run(args):
+    "Inject the messages and return the results"
+    texts = [text for _, text in load_corpus(args.corpus)]
+    wechatbot, server = setup(args.delay)
+    wechatbot.restrict = False
+    if args.workers is not None:
+        wechatbot.executor = ThreadPoolExecutor(
+            max_workers=args.workers, thread_name_prefix="Responder")
+    wechatbot.executor = AdmittedExecutor(wechatbot.executor)
+    max_pending = args.max_pending or wechatbot.max_pending
+    if args.rate_limit:
+        wechatbot.admission = AdmissionControl(
+            wechatbot.user_rate, wechatbot.user_burst, wechatbot.global_rate,
+            wechatbot.global_burst, max_pending)
+    else:
+        wechatbot.admission = AdmissionControl(1e9, 1e9, 1e9, 1e9,
+                                               max_pending)
+    transport = SimulatedTransport(args.users)
+    wechatbot.activate(transport)
+    start = time.perf_counter()
+    messages, injected = transport.inject(texts, args.count, args.rate)
+    # Wait for the requests that are still being handled
+    wechatbot.deactivate()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    # Busy and rate limited replies are instant, only the admitted
+    # requests tell how fast requests are handled
+    admitted = [m for m in messages if getattr(m, "admitted", False)]
+    latencies = sorted(m.finished - m.received for m in admitted)
+    admission = wechatbot.admission.stats()
+    rejected = admission[BUSY] + admission[RATE_LIMITED]
+    return {
+        "users": args.users,
+        "target_rate": args.rate,
+        "received": len(messages),
+        "inject_rate": injected,
+        "admitted": len(admitted),
+        "replied": sum(1 for m in admitted if m.replied is not None),
+        "busy": admission[BUSY],
+        "rate_limited": admission[RATE_LIMITED],
+        "ignored": len(messages) - len(admitted) - rejected,
+        "elapsed": elapsed,
+        "handled_rate": len(admitted) / elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1] if latencies else 0.0,
+    }
+
+def report(results):
+    "Print the results"
+    target = results["target_rate"]
+    print("Injected %d messages from %d users at %.1f/s (target %s)" % (
+        results["received"], results["users"], results["inject_rate"],
+        "unlimited" if target is None else str(target) + "/s"))
+    print("Admitted %d, busy %d, rate limited %d, not requests %d" % (
+        results["admitted"], results["busy"], results["rate_limited"],
+        results["ignored"]))
+    print("Handled %d admitted requests in %.2fs, %.1f requests/s, "
+          "%d replied" % (results["admitted"], results["elapsed"],
+                          results["handled_rate"], results["replied"]))
+    print("Latency of admitted requests: p50 %.2fms, p95 %.2fms, "
+          "p99 %.2fms, max %.2fms" % (
+              results["p50"] * 1000, results["p95"] * 1000,
+              results["p99"] * 1000, results["max"] * 1000))
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test wechatbot with "
+                                     "simulated users")
+    parser.add_argument("corpus", nargs="?",
+                        default=os.path.join(bench_dir, "corpus.jsonl"))
+    parser.add_argument("--count", type=int, default=20000,
+                        help="number of messages to inject")
+    parser.add_argument("--rate", type=float, default=2000,
+                        help="messages per second, 0 for as fast as possible")
+    parser.add_argument("--users", type=int, default=1000,
+                        help="number of simulated users sending messages")
+    parser.add_argument("--delay", type=float, default=0.02,
+                        help="seconds the stub servers wait to respond")
+    parser.add_argument("--workers", type=int,
+                        help="number of responder threads, the workers of "
+                        "wechatbot if not given")
+    parser.add_argument("--max-pending", type=int,
+                        help="max requests waiting or being handled, the "
+                        "max_pending of wechatbot if not given")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="keep the rate limits of wechatbot")
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+    args.corpus = os.path.abspath(args.corpus)
+    args.rate = args.rate or None
+    json_path = os.path.abspath(args.json) if args.json else None
+    results = in_work_dir(run, args)
+    report(results)
+    if json_path is not None:
+        with open(json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
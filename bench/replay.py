@@ -0,0 +1,235 @@
+"""
+Replay a request corpus through wechatbot without logging in to Wechat.
+The bot runs on a SimulatedTransport, and the responders talk to local stub
+servers instead of OpenWeatherMap, Alphavantage and Google. For each
+responder, it reports throughput, latency percentiles and peak memory.
+
+The corpus is a json lines file, each line is a message in format
+{"text": "stock track AAPL"}, an optional "sender" gives the user name.
+See bench/corpus.jsonl for an example.
+
+Usage: python bench/replay.py [corpus] [--repeat N] [--users N]
+       [--delay SECONDS] [--concurrency N] [--no-memory] [--json PATH]
+"""
+import argparse
+import functools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.join(bench_dir, "..")
+sys.path.append(root_dir)
+sys.path.append(bench_dir)
+from stubs import *
+from admission import AdmissionControl
+from transport import SimulatedMessage, SimulatedTransport
+from upstream import Upstream
+
+class TrackingExecutor():
+    """
+    Wrap the executor of wechatbot to know when a message is dispatched
+    and when the responder finished
+    """
+    def __init__(self, executor):
+        self.executor = executor
+
+    def submit(self, fn, msg, *args):
+        msg.dispatched = True
+        def run():
+            try:
+                fn(msg, *args)
+            finally:
+                msg.finish()
+        return self.executor.submit(run)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+class ReplayMessage(SimulatedMessage):
+    "SimulatedMessage that records when it was received and finished"
+    def __init__(self, transport, sender, text):
+        super().__init__(transport, sender, text)
+        self.dispatched = False
+        self.started = None
+        self.ended = None
+        self.release = None
+        self.done = threading.Event()
+
+    def finish(self):
+        self.ended = time.perf_counter()
+        self.done.set()
+        if self.release is not None:
+            self.release()
+
+
+def load_corpus(path):
+    "Return the messages in corpus, in (sender name, text) format"
+    corpus = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entry = json.loads(line)
+                corpus.append((entry.get("sender"), entry["text"]))
+    return corpus
+
+def percentile(values, p):
+    "Return the percentile p of sorted values"
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+def setup(delay):
+    """
+    Start the stub server and import wechatbot, responders use the stub
+    server. Return (wechatbot module, stub server)
+    """
+    server = StubServer(delay).start()
+    from responds import TranslationResponder
+    TranslationResponder.client_factory = functools.partial(
+        StubTranslateClient, server.url)
+    TranslationResponder.memory_path = None
+    import wechatbot
+    import logger
+    logger.set_level(logger.ERROR)
+    wechatbot.responder_map["weather"].get().weather_base = \
+        server.url + "/data/2.5/weather?"
+    wechatbot.responder_map["stock"].get().base_url = server.url + "/query?"
+    # The stub servers have no quota
+    for key in ("weather", "stock"):
+        wechatbot.responder_map[key].get().upstream = Upstream(key, 1e9, 1e9)
+    return wechatbot, server
+
+def replay(transport, messages, concurrency):
+    "Let the bot receive messages, at most concurrency are handled at once"
+    slots = threading.BoundedSemaphore(concurrency)
+    for msg in messages:
+        slots.acquire()
+        msg.release = slots.release
+        msg.started = time.perf_counter()
+        transport.receive(msg)
+        if not msg.dispatched:
+            msg.finish()
+    for msg in messages:
+        msg.done.wait()
+
+def run(args):
+    "Replay the corpus and return results of each responder"
+    corpus = load_corpus(args.corpus)
+    wechatbot, server = setup(args.delay)
+    wechatbot.executor = TrackingExecutor(wechatbot.executor)
+    wechatbot.restrict = False
+    if not args.rate_limit:
+        # The corpus is sent far faster than real users could
+        wechatbot.admission = AdmissionControl(1e9, 1e9, 1e9, 1e9, 1e9)
+    transport = SimulatedTransport(args.users, keep=True)
+    friends = transport.friends()
+    wechatbot.trace_file = args.trace
+    wechatbot.activate(transport)
+    by_name = {f.name: f for f in friends}
+    # Group the messages by responder key
+    groups = OrderedDict()
+    for i in range(args.repeat):
+        for n, (sender, text) in enumerate(corpus):
+            chat = by_name.get(sender) or friends[(i * len(corpus) + n) %
+                                                  len(friends)]
+            matched = wechatbot.router.route(chat.puid, text)
+            key = matched[1].key if matched is not None else "(ignored)"
+            groups.setdefault(key, []).append(ReplayMessage(transport, chat,
+                                                            text))
+    if not args.no_memory:
+        tracemalloc.start()
+    results = []
+    for key, messages in groups.items():
+        if not args.no_memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        replay(transport, messages, args.concurrency)
+        elapsed = time.perf_counter() - start
+        peak = 0
+        if not args.no_memory:
+            peak = tracemalloc.get_traced_memory()[1] - base
+        latencies = sorted(m.ended - m.started for m in messages)
+        results.append({
+            "key": key,
+            "requests": len(messages),
+            "replied": sum(1 for m in messages if m.replies),
+            "throughput": len(messages) / elapsed if elapsed > 0 else 0.0,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "peak_memory": peak,
+        })
+    wechatbot.deactivate()
+    server.shutdown()
+    return results
+
+def in_work_dir(fn, *args):
+    """
+    Return fn(*args) called in a temp dir with a copy of resources, so the
+    notes and caches in resources are untouched
+    """
+    work_dir = tempfile.mkdtemp(prefix="wechatbot-bench-")
+    shutil.copytree(os.path.join(root_dir, "resources"),
+                    os.path.join(work_dir, "resources"))
+    os.chdir(work_dir)
+    try:
+        return fn(*args)
+    finally:
+        os.chdir(root_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def report(results):
+    "Print results in a table"
+    print("%-12s %8s %8s %10s %9s %9s %9s %10s" % (
+        "responder", "requests", "replied", "req/s", "p50 ms", "p95 ms",
+        "p99 ms", "peak KB"))
+    for r in results:
+        print("%-12s %8d %8d %10.1f %9.2f %9.2f %9.2f %10.1f" % (
+            r["key"], r["requests"], r["replied"], r["throughput"],
+            r["p50"] * 1000, r["p95"] * 1000, r["p99"] * 1000,
+            r["peak_memory"] / 1024))
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a request corpus "
+                                     "through wechatbot offline")
+    parser.add_argument("corpus", nargs="?",
+                        default=os.path.join(bench_dir, "corpus.jsonl"))
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="times to replay the corpus")
+    parser.add_argument("--users", type=int, default=50,
+                        help="number of fake users sending messages")
+    parser.add_argument("--delay", type=float, default=0.02,
+                        help="seconds the stub servers wait to respond")
+    parser.add_argument("--concurrency", type=int, default=32,
+                        help="max messages being handled at once")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="keep the rate limits of wechatbot")
+    parser.add_argument("--trace",
+                        help="write the spans of every request to this file")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="do not trace memory, it slows down the bot")
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+    args.corpus = os.path.abspath(args.corpus)
+    json_path = os.path.abspath(args.json) if args.json else None
+    if args.trace is not None:
+        args.trace = os.path.abspath(args.trace)
+    results = in_work_dir(run, args)
+    report(results)
+    if json_path is not None:
+        with open(json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Local stub servers of OpenWeatherMap, Alphavantage and the translate
+service. They respond with made up data after an optional delay, so the
+responders can be run offline.
+"""
+import datetime
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from httpclient import *
+from translation import TranslateClient
+
+class StubHandler(BaseHTTPRequestHandler):
+    "Handle requests to all the stub services"
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        time.sleep(self.server.delay)
+        if url.path == "/data/2.5/weather":
+            self._send_json(self._weather(query))
+        elif url.path == "/query":
+            self._send_json(self._stock(query))
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length).decode())
+        time.sleep(self.server.delay)
+        if self.path == "/translate":
+            self._send_json(["[" + body["target"] + "] " + text
+                             for text in body["texts"]])
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _weather(self, query):
+        name = query.get("q", "Toronto").title()
+        temp = round(random.uniform(-10, 30), 1)
+        return {
+            "name": name,
+            "weather": [{"main": "Clouds", "description": "broken clouds"}],
+            "main": {"temp": temp, "temp_min": temp - 2,
+                     "temp_max": temp + 2},
+        }
+
+    def _stock(self, query):
+        symbol = query.get("symbol", "")
+        if symbol.upper() == "INVALID":
+            return {"Error Message": "Invalid API call"}
+        series = {}
+        day = datetime.date.today()
+        price = 100.0
+        while len(series) < 100:
+            if day.weekday() < 5:
+                series[day.strftime("%Y-%m-%d")] = {
+                    "1. open": "%.4f" % price,
+                    "2. high": "%.4f" % (price * 1.02),
+                    "3. low": "%.4f" % (price * 0.98),
+                    "4. close": "%.4f" % (price * 1.01),
+                    "5. volume": str(random.randint(1000, 100000)),
+                }
+                price *= random.uniform(0.97, 1.03)
+            day -= datetime.timedelta(days=1)
+        return {"Meta Data": {"2. Symbol": symbol},
+                "Time Series (Daily)": series}
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Serve all the stub services on a local port in a background thread
+    Var: url: The base url of the server
+    """
+    daemon_threads = True
+
+    def __init__(self, delay=0.0, port=0):
+        """
+        Param: delay: Seconds to wait before responding, like a slow upstream
+        Param: port: The port to listen on, a free port if 0
+        """
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.delay = delay
+        self.url = "http://127.0.0.1:" + str(self.server_port)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True,
+                         name="StubServer").start()
+        return self
+
+
+class StubTranslateClient(TranslateClient):
+    "TranslateClient that sends the texts to the stub translate service"
+    def __init__(self, url, http=None):
+        """
+        Param: url: The base url of the stub server
+        Param: http: The HttpClient to use, shared_client if None
+        """
+        self.url = url + "/translate"
+        self.http = http or shared_client
+
+    def translate(self, texts, target_lang):
+        body = json.dumps({"texts": texts, "target": target_lang}).encode()
+        data = self.http.request("POST", self.url, body,
+                                 {"Content-Type": "application/json"})
+        return json.loads(data.decode())
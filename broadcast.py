@@ -0,0 +1,181 @@
+import json
+import os
+import queue
+import threading
+import time
+from logger import *
+from ratelimit import *
+
+class Broadcast():
+    """
+    Broadcast sends one message to many chats, such as the greeting to all
+    users. Messages are sent by a few threads from a queue, no faster than
+    rate per second, and failed sends are retried with backoff.
+    Every job has a journal file that records the chats it was sent to, if
+    the bot crashed during a job, running the job with the same id again
+    skips them and only sends to the rest. A finished job is marked done in
+    its journal, job_id() only returns its id again if it was interrupted.
+    """
+    def __init__(self, send=None, concurrency=2, rate=1.0, burst=1,
+                 retries=3, backoff=1.0, journal_dir="resources/broadcasts",
+                 progress=None):
+        """
+        Param: send: Function that takes (chat, message) and sends it, calls
+            chat.send(message) if None
+        Param: concurrency: Number of threads sending messages
+        Param: rate: Max messages sent per second
+        Param: burst: Max messages sent at once before being rate limited
+        Param: retries: Times to retry a failed send
+        Param: backoff: Seconds to wait before the first retry, doubles for
+            each retry after
+        Param: journal_dir: The folder of journal files, None to not keep
+            journals, then jobs can not be resumed
+        Param: progress: Function called with the counters in dict after
+            every send, logs the progress if None
+        """
+        self.send = send or (lambda chat, message: chat.send(message))
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.backoff = backoff
+        self.journal_dir = journal_dir
+        self.progress = progress
+        self.logger = Logger("Broadcast")
+
+    def run(self, job_id, message, chats):
+        """
+        Send message to every chat and wait until all are done. Chats must
+        have unique puid. Return the counters in dict: total, sent, failed,
+        and skipped which were sent before the job was resumed
+        """
+        done = self._read_journal(job_id)
+        counters = {"job": job_id, "total": len(chats), "sent": 0,
+                    "failed": 0, "skipped": 0}
+        pending = queue.Queue()
+        for chat in chats:
+            if chat.puid in done:
+                counters["skipped"] += 1
+            else:
+                pending.put(chat)
+        self.logger.log("Broadcast %s: %d chats, %d sent before", job_id,
+                        len(chats), counters["skipped"])
+        lock = threading.Lock()
+        journal = self._open_journal(job_id)
+
+        def worker():
+            while True:
+                try:
+                    chat = pending.get_nowait()
+                except queue.Empty:
+                    return
+                ok = self._send(chat, message)
+                with lock:
+                    counters["sent" if ok else "failed"] += 1
+                    if journal is not None:
+                        journal.write(json.dumps(
+                            {"puid": chat.puid, "ok": ok}) + "\n")
+                        journal.flush()
+                    self._report(dict(counters))
+
+        threads = [threading.Thread(target=worker, daemon=True,
+                                    name="Broadcast")
+                   for _ in range(max(1, self.concurrency))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if journal is not None:
+            journal.write(json.dumps({"done": True}) + "\n")
+            journal.close()
+        self.logger.log("Broadcast %s finished: %d sent, %d failed, "
+                        "%d skipped", job_id, counters["sent"],
+                        counters["failed"], counters["skipped"])
+        return counters
+
+    def job_id(self, name):
+        """
+        Return the id of the last job of name if it was interrupted, so it
+        is resumed, or the id of a new job, such as 'greeting-3' for the
+        third greeting. The journal of the finished job before is removed
+        """
+        if self.journal_dir is None:
+            return name + "-" + str(int(time.time()))
+        runs = []
+        try:
+            for file in os.listdir(self.journal_dir):
+                run = file[len(name) + 1:-len(".jsonl")]
+                if file.startswith(name + "-") and file.endswith(".jsonl") \
+                        and run.isdigit():
+                    runs.append(int(run))
+        except OSError:
+            pass
+        if not runs:
+            return name + "-1"
+        last = name + "-" + str(max(runs))
+        if not self._finished(last):
+            return last
+        try:
+            os.remove(self._journal_path(last))
+        except OSError:
+            pass
+        return name + "-" + str(max(runs) + 1)
+
+    def _send(self, chat, message):
+        "Send with retries, return True if sent"
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            self.bucket.acquire()
+            try:
+                self.send(chat, message)
+                return True
+            except Exception as e:
+                self.logger.warning("Failed to send to %s: %r", chat.puid, e)
+        return False
+
+    def _report(self, counters):
+        "Report the progress"
+        if self.progress is not None:
+            self.progress(counters)
+            return
+        self.logger.log("Broadcast %s: %d/%d sent, %d failed", counters["job"],
+                        counters["sent"] + counters["skipped"],
+                        counters["total"], counters["failed"])
+
+    def _journal_path(self, job_id):
+        return os.path.join(self.journal_dir, job_id + ".jsonl")
+
+    def _read_journal(self, job_id):
+        "Return the puids the job was sent to"
+        if self.journal_dir is None:
+            return set()
+        done = set()
+        try:
+            with open(self._journal_path(job_id), "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line may be cut by a crash
+                        continue
+                    if entry.get("ok"):
+                        done.add(entry["puid"])
+        except OSError:
+            pass
+        return done
+
+    def _finished(self, job_id):
+        "Return True if the journal of the job is marked done"
+        try:
+            with open(self._journal_path(job_id), "r") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return False
+        return bool(lines) and lines[-1] == json.dumps({"done": True})
+
+    def _open_journal(self, job_id):
+        "Open the journal file of the job for appending"
+        if self.journal_dir is None:
+            return None
+        os.makedirs(self.journal_dir, exist_ok=True)
+        return open(self._journal_path(job_id), "a")
@@ -0,0 +1,181 @@
+import threading
+import time
+from collections import OrderedDict
+from logger import *
+
+class LRUCache():
+    """
+    Thread safe in-memory cache. It keeps at most maxsize entries and
+    evicts the least recently used one first. Every entry expires after its
+    own ttl. The counters hits, misses and evictions keep track of how well
+    the cache works.
+    """
+    def __init__(self, maxsize=128, ttl=60):
+        """
+        Param: maxsize: Max number of entries in the cache
+        Param: ttl: Default seconds before an entry expires
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # key:(value, expire time)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None, accept=None):
+        """
+        Return the value of the key, default if the key is not cached or
+        already expired. If accept is given, an expired value is still
+        returned when accept(value) returns True
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (entry[1] <= time.time() and
+                                 (accept is None or not accept(entry[0]))):
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, ttl=None):
+        "Cache the value, expires after ttl seconds, default ttl if None"
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            self.entries[key] = (value, time.time() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def remove(self, key):
+        "Remove the key from cache if it exists"
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        "Remove everything in the cache"
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        "Return the counters and size of the cache in dict"
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+
+class SWRCache():
+    """
+    Stale-while-revalidate cache. A fresh value is returned right away. A
+    stale value is returned right away as well, while a background thread
+    loads the new value. Only a missing value is loaded in the calling
+    thread. If disk is given, every loaded value is saved to that
+    DiskCache as well, and values not in memory are looked up there first,
+    so the values survive restarts. At most maxsize values are kept in
+    memory, the least recently used one is evicted first.
+    """
+    def __init__(self, loader, ttl, disk=None, namespace="",
+                 background_loader=None, maxsize=1024):
+        """
+        Param: loader: Function that takes a key and returns its new value,
+            the value must be json serializable if disk is given
+        Param: ttl: Seconds before a value becomes stale
+        Param: disk: The DiskCache to save the values to
+        Param: namespace: Prefix of the keys in disk, so caches sharing the
+            same DiskCache do not mix up
+        Param: background_loader: Function used instead of loader to load
+            stale values in background, such as one that yields to loads
+            that users are waiting for
+        Param: maxsize: Max number of values kept in memory
+        """
+        self.loader = loader
+        self.background_loader = background_loader or loader
+        self.ttl = ttl
+        self.disk = disk
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # key:(value, load time)
+        self.refreshing = set()         # keys being loaded in background
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refresh_errors = 0
+        self.logger = Logger("SWRCache")
+
+    def get(self, key):
+        "Return the value of the key, load it if it is not cached"
+        if key not in self.entries and self.disk is not None:
+            saved = self.disk.get_entry(self.namespace + key)
+            if saved is not None:
+                with self.lock:
+                    if key not in self.entries:
+                        self._put(key, (saved[0], saved[1]))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                if time.time() - entry[1] < self.ttl:
+                    self.hits += 1
+                    return entry[0]
+                self.stale_hits += 1
+                if key not in self.refreshing:
+                    self.refreshing.add(key)
+                    threading.Thread(target=self._refresh, args=(key,),
+                                     daemon=True).start()
+                return entry[0]
+            self.misses += 1
+        return self._load(key)
+
+    def stats(self):
+        "Return the counters and size of the cache in dict"
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "refresh_errors": self.refresh_errors,
+            }
+
+    def _load(self, key, loader=None):
+        "Load the value of the key and cache it"
+        value = (loader or self.loader)(key)
+        with self.lock:
+            self._put(key, (value, time.time()))
+        if self.disk is not None:
+            self.disk.put(self.namespace + key, value, self.ttl)
+        return value
+
+    def _refresh(self, key):
+        "Load the value in background, keep the stale one if failed"
+        try:
+            self._load(key, self.background_loader)
+        except Exception as e:
+            with self.lock:
+                self.refresh_errors += 1
+            self.logger.warning("Failed to refresh %s: %r", key, e)
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def _put(self, key, entry):
+        "Cache the entry, evict the least recently used ones, must hold lock"
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
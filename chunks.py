@@ -0,0 +1,38 @@
+def split_messages(respond, size=2000):
+    """
+    Yield the messages to send for a respond, each at most size characters
+    long. The respond is a str, or an iterable of str chunks, such as a
+    generator, that is only read as the messages are sent. Chunks are put
+    together into one message until it is full, a chunk longer than size
+    is split at the last line break that fits, or at size if there is none.
+    Param: respond: str or iterable of str
+    Param: size: Max number of characters in one message
+    """
+    if isinstance(respond, str):
+        respond = (respond,)
+    parts = []
+    length = 0
+    for chunk in respond:
+        for part in _split_chunk(chunk, size):
+            if length + len(part) > size and parts:
+                message = "".join(parts).strip()
+                if message:
+                    yield message
+                parts = []
+                length = 0
+            parts.append(part)
+            length += len(part)
+    message = "".join(parts).strip()
+    if message:
+        yield message
+
+def _split_chunk(chunk, size):
+    "Yield the parts of a chunk, each at most size characters long"
+    start = 0
+    while len(chunk) - start > size:
+        end = chunk.rfind("\n", start, start + size) + 1
+        if end <= start:
+            end = start + size
+        yield chunk[start:end]
+        start = end
+    yield chunk[start:]
@@ -0,0 +1,234 @@
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from logger import *
+from cache import *
+
+class DiskCache():
+    """
+    Cache of upstream responses on disk, shared by all responders, so the
+    responses survive restarts. Every entry is a zlib compressed json file,
+    and the index file keeps the key, size, expire time and hits of every
+    entry, so a lookup only reads the index in memory and one entry file.
+    Files are written to a temp file first and then renamed, a crash never
+    leaves a broken entry or index. When the files take more than max_bytes
+    the expired entries and then the least recently used ones are removed.
+    The entries with the most hits can be preloaded into memory at start.
+    """
+    def __init__(self, path="resources/cache", max_bytes=64 * 1024 * 1024,
+                 memory_size=256):
+        """
+        Param: path: The folder of the entry files and the index file
+        Param: max_bytes: Max total size of the entry files
+        Param: memory_size: Max number of entries kept in memory
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key:[file name, size, stored time, expire time, hits, used time]
+        self.index = None
+        self.size = 0
+        self.memory = LRUCache(memory_size, float("inf"))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dirty = threading.Event()
+        self.writer = None
+        self.logger = Logger("DiskCache")
+
+    def get(self, key, accept=None):
+        """
+        Return the value of the key, None if it is not cached or expired.
+        If accept is given, an expired value is still returned when
+        accept(value) returns True
+        """
+        entry = self.get_entry(key)
+        if entry is None:
+            return None
+        value, stored, expires = entry
+        if expires <= time.time() and (accept is None or not accept(value)):
+            return None
+        return value
+
+    def get_entry(self, key):
+        "Return (value, stored time, expire time) of the key, or None"
+        return self._entry(key, True)
+
+    def put(self, key, value, ttl):
+        "Cache the value, it expires after ttl seconds"
+        data = zlib.compress(json.dumps(value, separators=(",", ":"))
+                             .encode())
+        name = hashlib.sha1(key.encode()).hexdigest() + ".z"
+        now = time.time()
+        with self.lock:
+            # Files not in the index are deleted when it is loaded
+            self._load_index()
+        self._write(name, data)
+        with self.lock:
+            old = self.index.get(key)
+            hits = 0
+            if old is not None:
+                self.size -= old[1]
+                hits = old[4]
+            self.index[key] = [name, len(data), now, now + ttl, hits, now]
+            self.size += len(data)
+            self.memory.put(key, (value, now, now + ttl))
+            removed = self._evict() if self.size > self.max_bytes else []
+        self._delete(removed)
+        self.dirty.set()
+
+    def remove(self, key):
+        "Remove the key from cache if it exists"
+        with self.lock:
+            self._load_index()
+            meta = self.index.pop(key, None)
+            if meta is None:
+                return
+            self.size -= meta[1]
+            self.memory.remove(key)
+        self._delete([meta[0]])
+        self.dirty.set()
+
+    def preload(self, count=64):
+        """
+        Read the count entries with the most hits that are not expired into
+        memory, return the number of entries read
+        """
+        now = time.time()
+        with self.lock:
+            self._load_index()
+            hot = sorted((meta[4], key) for key, meta in self.index.items()
+                         if meta[3] > now)
+        loaded = 0
+        for _, key in reversed(hot[-count:] if count > 0 else []):
+            if self._entry(key, False) is not None:
+                loaded += 1
+        self.logger.log("Preloaded %d of %d entries", loaded, len(hot))
+        return loaded
+
+    def flush(self):
+        "Save the index file now if it has changed"
+        if self.dirty.is_set():
+            self.dirty.clear()
+            self._save_index()
+
+    def stats(self):
+        "Return the counters and size of the cache in dict"
+        with self.lock:
+            return {
+                "entries": len(self.index or {}),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _entry(self, key, count):
+        "Return the entry of get_entry(), count it as a hit if count"
+        with self.lock:
+            self._load_index()
+            meta = self.index.get(key)
+            if meta is None:
+                self.misses += 1
+                return None
+            name = meta[0]
+            if count:
+                meta[4] += 1
+                meta[5] = time.time()
+                self.hits += 1
+                self.dirty.set()
+        entry = self.memory.get(key)
+        if entry is not None:
+            return entry
+        try:
+            with open(os.path.join(self.path, name), "rb") as f:
+                value = json.loads(zlib.decompress(f.read()).decode())
+        except (OSError, ValueError, zlib.error):
+            self.logger.warning("Entry of %s is missing or broken", key)
+            self.remove(key)
+            return None
+        entry = (value, meta[2], meta[3])
+        self.memory.put(key, entry)
+        return entry
+
+    def _load_index(self):
+        """
+        Read the index file on first use, drop entries whose file is
+        missing and files that are not in the index. Must hold the lock
+        """
+        if self.index is not None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            with open(os.path.join(self.path, "index.json"), "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        files = set(name for name in os.listdir(self.path)
+                    if name.endswith(".z"))
+        self.index = {key: meta for key, meta in index.items()
+                      if meta[0] in files}
+        self.size = sum(meta[1] for meta in self.index.values())
+        self._delete(files - set(meta[0] for meta in self.index.values()))
+        self.writer = threading.Thread(target=self._index_loop, daemon=True,
+                                       name="DiskCacheIndex")
+        self.writer.start()
+        atexit.register(self.flush)
+
+    def _evict(self, ratio=0.9):
+        """
+        Remove entries until the size is below ratio of max_bytes, expired
+        ones first, then the least recently used. Return the file names to
+        delete, must hold the lock
+        """
+        now = time.time()
+        order = sorted(self.index.items(),
+                       key=lambda item: (item[1][3] > now, item[1][5]))
+        names = []
+        for key, meta in order:
+            if self.size <= self.max_bytes * ratio:
+                break
+            del self.index[key]
+            self.memory.remove(key)
+            self.size -= meta[1]
+            self.evictions += 1
+            names.append(meta[0])
+        return names
+
+    def _index_loop(self):
+        "Save the index whenever it changed, at most once a second"
+        while True:
+            self.dirty.wait()
+            time.sleep(1)
+            self.flush()
+
+    def _save_index(self):
+        "Write the index file atomically"
+        with self.lock:
+            data = json.dumps(self.index, separators=(",", ":"))
+        self._write("index.json", data.encode())
+
+    def _write(self, name, data):
+        "Write the file atomically"
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, name)
+        temp = path + "." + str(threading.get_ident()) + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(data)
+        os.replace(temp, path)
+
+    def _delete(self, names):
+        "Delete the entry files, ignore the ones already gone"
+        for name in names:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+
+# The disk cache shared by all responders
+response_cache = DiskCache()
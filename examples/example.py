@@ -57,6 +57,9 @@ class ComplexResponder(Responder):
     For instance, `note add {your_note}` require three parts: key, which is
     the keyword `note`, action, which is `add`, and detail which is
     `{your_note}`.
+    Since it stores the request on itself in receive(), wechatbot can only
+    pass one request at a time to it. See ConcurrentResponder for a
+    responder that can handle many requests at the same time.
     """
     def __init__(self):
         # It is recommend to use logger to do log, for debug purpose
@@ -104,3 +107,31 @@ class ComplexResponder(Responder):
     def _logic(self):
         return "puid = " + self.puid + ", action = " + self.action +\
                 ", detail = " + self.detail
+
+
+class ConcurrentResponder(Responder):
+    """
+    ConcurrentResponder handles complex requests like ComplexResponder, but
+    it reads everything from the Request object instead of saving it on
+    itself. WechatBot can then run it for many users at the same time.
+    """
+    # Instead of key(), is_complex() and actions(), set them as class
+    # attributes. WechatBot can then find this responder without creating
+    # it, and only creates it when the first 'concurrent' request arrives
+    keyword = "concurrent"
+    complex = True
+    action_names = ("action1", "action2")
+    # Optional, other names of the keyword and actions
+    alias_names = ("con",)
+    action_alias_names = {"a1": "action1"}
+
+    def __init__(self):
+        self.logger = Logger("ConcurrentResponder")
+        self.logger.log("Initialized new ConcurrentResponder")
+
+    # Instead of receive() and respond(), override handle(). The request
+    # has attributes puid, key, action and detail. Do not store them on
+    # self, other requests may be handled by this responder meanwhile
+    def handle(self, request):
+        return "puid = " + request.puid + ", action = " + request.action +\
+                ", detail = " + request.detail
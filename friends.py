@@ -0,0 +1,159 @@
+import os
+import threading
+from logger import *
+
+class FriendIndex():
+    """
+    Index of friends by puid, and by name, remark name and nick name in
+    lower case. It is built in one pass over the friend list, and later
+    refreshes only re-index the friends that are new, changed or gone.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.friends = {}   # puid:friend
+        self.names = {}     # name:[puid]
+        self.indexed = {}   # puid:names it is indexed by
+
+    def refresh(self, friends):
+        """
+        Update the index with the current friend list
+        Return (number of new or changed friends, number of removed friends)
+        """
+        changed = 0
+        seen = set()
+        with self.lock:
+            for friend in friends:
+                puid = friend.puid
+                seen.add(puid)
+                self.friends[puid] = friend
+                names = self._names(friend)
+                old = self.indexed.get(puid)
+                if old == names:
+                    continue
+                if old is not None:
+                    self._unindex(puid, old)
+                self._index(puid, names)
+                changed += 1
+            removed = [puid for puid in self.indexed if puid not in seen]
+            for puid in removed:
+                self._unindex(puid, self.indexed[puid])
+                del self.friends[puid]
+        return changed, len(removed)
+
+    def find(self, name):
+        "Return the friend with the name, remark name or nick name, or None"
+        with self.lock:
+            puids = self.names.get(name.lower())
+            if not puids:
+                return None
+            return self.friends[puids[0]]
+
+    def search(self, name):
+        """
+        Return the friend with the name, or else the first friend whose
+        name, remark name or nick name has name in it, like the search of
+        wxpy. Return (friend, True if the name matched exactly), or
+        (None, False) if no friend is found
+        """
+        friend = self.find(name)
+        if friend is not None:
+            return friend, True
+        name = name.lower()
+        with self.lock:
+            for puid, names in self.indexed.items():
+                if any(name in n for n in names):
+                    return self.friends[puid], False
+        return None, False
+
+    def get(self, puid):
+        "Return the friend with the puid, None if not found"
+        return self.friends.get(puid)
+
+    def __len__(self):
+        return len(self.friends)
+
+    def _names(self, friend):
+        "Return the names the friend is indexed by"
+        names = set()
+        for attr in ("name", "remark_name", "nick_name"):
+            value = getattr(friend, attr, None)
+            if value:
+                names.add(value.lower())
+        return frozenset(names)
+
+    def _index(self, puid, names):
+        for name in names:
+            self.names.setdefault(name, []).append(puid)
+        self.indexed[puid] = names
+
+    def _unindex(self, puid, names):
+        for name in names:
+            puids = self.names.get(name)
+            if puids is not None:
+                puids.remove(puid)
+                if not puids:
+                    del self.names[name]
+        del self.indexed[puid]
+
+
+class Whitelist():
+    """
+    The puids of users who can access the bot. Users are given by names in
+    names and in the file at path, one name per line, and found through
+    the FriendIndex, by the whole name, remark name or nick name, or else
+    by part of one as wxpy did. Call refresh() to pick up new friends or
+    changes of the file, checking a puid is a set lookup.
+    """
+    def __init__(self, index, names=(), path=None, always=()):
+        """
+        Param: index: The FriendIndex to find users by name
+        Param: names: Names of the users
+        Param: path: File that has more names, it can be edited while the
+            bot is running, None if there is no such file
+        Param: always: puids that are always in the whitelist
+        """
+        self.index = index
+        self.names = list(names)
+        self.path = path
+        self.always = set(always)
+        self.puids = frozenset(self.always)
+        self.logger = Logger("Whitelist")
+
+    def refresh(self):
+        "Find the users again, return the names that are not found"
+        puids = set(self.always)
+        missing = []
+        for name in self.names + self._read_file():
+            friend, exact = self.index.search(name)
+            if friend is None:
+                missing.append(name)
+                continue
+            if not exact:
+                self.logger.warning("User %s is found by part of the name: "
+                                    "%s, use the full name to be sure",
+                                    name, friend)
+            puids.add(friend.puid)
+        self.puids = frozenset(puids)
+        if missing:
+            self.logger.warning("Users not found: %s", missing)
+        return missing
+
+    def __contains__(self, puid):
+        return puid in self.puids
+
+    def __iter__(self):
+        return iter(self.puids)
+
+    def __len__(self):
+        return len(self.puids)
+
+    def __repr__(self):
+        return "<Whitelist: " + str(len(self.puids)) + " users>"
+
+    def _read_file(self):
+        "Return the names in the file, lines start with # are ignored"
+        if self.path is None or not os.path.exists(self.path):
+            return []
+        with open(self.path, "r", encoding="utf-8") as f:
+            return [line.strip() for line in f
+                    if line.strip() and not line.startswith("#")]
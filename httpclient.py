@@ -0,0 +1,142 @@
+import http.client
+import json
+import threading
+import time
+import urllib.parse
+from logger import *
+
+class HttpError(Exception):
+    "Raised when the server responds with an error status"
+    def __init__(self, status, url):
+        """
+        Param: status: The http status code
+        Param: url: The url that was requested
+        """
+        super().__init__("HTTP " + str(status) + " from " + url)
+        self.status = status
+        self.url = url
+
+
+class HttpClient():
+    """
+    HttpClient is the http layer shared by all responders. It keeps alive
+    connections to every host and reuses them, limits the number of
+    requests running against one host at the same time, and gives up on
+    hung servers after timeout. Failed GET requests, connection errors and
+    5xx responses are retried a bounded number of times with backoff.
+    """
+    def __init__(self, timeout=10, retries=2, backoff=0.5, max_per_host=4):
+        """
+        Param: timeout: Seconds to wait for connecting or reading, also the
+            longest time to wait for a free slot of a host
+        Param: retries: Times to retry a failed GET request
+        Param: backoff: Seconds to wait before the first retry, doubles for
+            each retry after
+        Param: max_per_host: Max number of requests running against the
+            same host at the same time, also the max idle connections kept
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_per_host = max_per_host
+        self.lock = threading.Lock()
+        self.idle = {}      # (scheme, host, port):[idle connections]
+        self.slots = {}     # (scheme, host, port):semaphore
+        self.logger = Logger("HttpClient")
+
+    def get(self, url, headers=None):
+        "Send GET request, return the body in bytes"
+        return self.request("GET", url, headers=headers)
+
+    def get_json(self, url, headers=None):
+        "Send GET request, return the body parsed as json"
+        return json.loads(self.get(url, headers).decode())
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Send request and return the body in bytes
+        Raise HttpError if the server responds with 4xx or 5xx status
+        Raise OSError or http.client.HTTPException if the connection failed
+        """
+        parts = urllib.parse.urlsplit(url)
+        host = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        headers = dict(headers or {})
+        retries = self.retries if method in ("GET", "HEAD") else 0
+        slot = self._slot(host)
+        if not slot.acquire(timeout=self.timeout):
+            raise TimeoutError("Too many requests running against " +
+                               parts.netloc)
+        try:
+            for attempt in range(retries + 1):
+                if attempt > 0:
+                    self.logger.warning("Retry %s %s (%s)", method, url,
+                                        error)
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+                conn = self._checkout(host)
+                try:
+                    conn.request(method, path, body, headers)
+                    response = conn.getresponse()
+                    data = response.read()
+                except (OSError, http.client.HTTPException) as e:
+                    conn.close()
+                    error = e
+                    continue
+                if response.will_close:
+                    conn.close()
+                else:
+                    self._checkin(host, conn)
+                if response.status >= 500:
+                    error = HttpError(response.status, url)
+                    continue
+                if response.status >= 400:
+                    raise HttpError(response.status, url)
+                return data
+            raise error
+        finally:
+            slot.release()
+
+    def close(self):
+        "Close all idle connections"
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _slot(self, host):
+        "Return the semaphore that limits requests to the host"
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = threading.BoundedSemaphore(
+                    self.max_per_host)
+            return self.slots[host]
+
+    def _checkout(self, host):
+        "Return an idle connection to the host, or a new one"
+        with self.lock:
+            conns = self.idle.get(host)
+            if conns:
+                return conns.pop()
+        scheme, hostname, port = host
+        if scheme == "https":
+            return http.client.HTTPSConnection(hostname, port,
+                                               timeout=self.timeout)
+        return http.client.HTTPConnection(hostname, port,
+                                          timeout=self.timeout)
+
+    def _checkin(self, host, conn):
+        "Keep the connection for later requests to the host"
+        with self.lock:
+            conns = self.idle.setdefault(host, [])
+            if len(conns) < self.max_per_host:
+                conns.append(conn)
+                return
+        conn.close()
+
+
+# The client shared by all responders
+shared_client = HttpClient()
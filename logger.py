@@ -1,26 +1,186 @@
+import atexit
+import json
+import queue
+import sys
+import threading
+import time
+
+# Log levels
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+level_names = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING",
+               ERROR: "ERROR"}
+
+class LogWriter():
+    """
+    LogWriter writes the logs of all loggers in a background thread, so
+    logging only puts a record in a queue. The records are formatted and
+    written in batches. Set json_lines to True to write one json object
+    per log instead of the console format.
+    """
+    def __init__(self, stream=None, json_lines=False, batch_size=256):
+        """
+        Param: stream: The file to write to, sys.stdout if None
+        Param: json_lines: Write json lines instead of console format
+        Param: batch_size: Max number of records written at once
+        """
+        self.stream = stream
+        self.json_lines = json_lines
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def put(self, record):
+        "Put record in format (time, level, parent, msg, args) to the queue"
+        if self.thread is None:
+            self._start()
+        self.queue.put(record)
+
+    def flush(self):
+        "Wait until all the records in the queue are written"
+        if self.thread is not None:
+            self.queue.join()
+
+    def _start(self):
+        "Start the background thread"
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop,
+                                               daemon=True, name="LogWriter")
+                self.thread.start()
+
+    def _loop(self):
+        "Write records in batches"
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                lines = []
+                for record in batch:
+                    lines.extend(self._safe_format(record))
+                stream = self.stream or sys.stdout
+                stream.write("".join(lines))
+                stream.flush()
+            except Exception as e:
+                sys.stderr.write("LogWriter: failed to write logs: " +
+                                 repr(e) + "\n")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _safe_format(self, record):
+        """
+        Return the lines of the record, if it can not be formatted, such as
+        args that do not match msg, write the error to stderr and return
+        the record with repr of msg and args
+        """
+        try:
+            return self._format(record)
+        except Exception as e:
+            created, level, parent, msg, args = record
+            sys.stderr.write("LogWriter: failed to format log of " +
+                             str(parent) + ": " + repr(e) + "\n")
+            return self._format((created, level, parent,
+                                 repr(msg) + " " + repr(args), ()))
+
+    def _format(self, record):
+        "Return the lines of the record"
+        created, level, parent, msg, args = record
+        if level is None:
+            # span
+            if self.json_lines:
+                return []
+            return ["========================= END " +
+                    "=========================\n"]
+        if args:
+            msg = msg % args
+        if self.json_lines:
+            return [json.dumps({
+                "time": created,
+                "level": level_names.get(level, str(level)),
+                "logger": parent,
+                "msg": msg if isinstance(msg, str) else list(msg),
+            }, ensure_ascii=False) + "\n"]
+        if isinstance(msg, str):
+            return ["[" + parent + "]>>>>> " + msg + " <<<<<\n"]
+        return ["[" + parent + "]>>>>>\n"] + \
+               [str(m) + "\n" for m in msg] + ["<<<<<\n"]
+
+
+# The writer shared by all loggers
+log_writer = LogWriter()
+atexit.register(log_writer.flush)
+# Level of loggers that do not have their own level
+default_level = INFO
+
+def set_level(level):
+    "Set the level of loggers that do not have their own level"
+    global default_level
+    default_level = level
+
+def use_json_lines(path=None):
+    "Write logs as json lines to the file at path, or to the console if None"
+    log_writer.flush()
+    if path is not None:
+        log_writer.stream = open(path, "a", encoding="utf-8")
+    log_writer.json_lines = True
+
+
 class Logger():
     """
-    Simple logger that print informations in console
+    Simple logger that print informations in console. Logs are written by
+    a background thread, and nothing is done when the logger is disabled
+    or the level is too low. Pass the values as args instead of joining
+    strings, they are only formatted when the log is written:
+        logger.log("Request detail: %s", detail)
     """
-    def __init__(self, parent, enable=True):
+    def __init__(self, parent, enable=True, level=None):
         """
         Param: parent: The component's name that is currently using the logger
         Param: enable: Enabled the logger, False will not print on console
+        Param: level: The lowest level to log, default_level if None
         """
         self.parent = parent
         self.enable = enable
+        self.level = level
+
+    def enabled_for(self, level):
+        "Return True if log at the given level will be written"
+        if not self.enable:
+            return False
+        if self.level is None:
+            return level >= default_level
+        return level >= self.level
+
+    def log(self, msg, *args, level=INFO):
+        """
+        Param: msg: Can be either str or list
+        Param: args: Values to format into msg with %, only if logged
+        Param: level: The level of this log
+        """
+        if self.enabled_for(level):
+            log_writer.put((time.time(), level, self.parent, msg, args))
+
+    def debug(self, msg, *args):
+        self.log(msg, *args, level=DEBUG)
+
+    def info(self, msg, *args):
+        self.log(msg, *args, level=INFO)
+
+    def warning(self, msg, *args):
+        self.log(msg, *args, level=WARNING)
 
-    def log(self, msg):
-        "Param: msg: Can be either str or list"
-        if self.enable:
-            if isinstance(msg, str):
-                print("[" + self.parent + "]>>>>>", msg, "<<<<<")
-            else:
-                print("[" + self.parent + "]>>>>>")
-                for m in msg:
-                    print(m)
-                print("<<<<<")
+    def error(self, msg, *args):
+        self.log(msg, *args, level=ERROR)
 
     def span(self):
-        "Separate logs"
-        print("========================= END =========================")
+        "Separate logs, shown along with the info logs"
+        if self.enabled_for(INFO):
+            log_writer.put((time.time(), None, self.parent, None, ()))
@@ -0,0 +1,177 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from logger import *
+from tracer import tracer
+
+class Histogram():
+    """
+    Latency histogram with exponential buckets, from 0.1 ms to about a
+    minute, each bucket is 20% wider than the previous one. Percentiles are
+    estimated by the upper bound of the bucket they fall in.
+    """
+    bounds = [0.0001 * 1.2 ** i for i in range(75)]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        "Record one latency in seconds"
+        self.buckets[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        "Return the estimated latency at percentile p, from 0 to 100"
+        if self.count == 0:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                if i == len(self.bounds):
+                    return self.max
+                return min(self.bounds[i], self.max)
+        return self.max
+
+    def mean(self):
+        "Return the mean latency"
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+
+class Metrics():
+    """
+    Metrics records the number of requests, number of errors and latency
+    histogram of each (responder key, stage), such as ('stock', 'upstream').
+    Other components can add gauges, functions that return a dict of their
+    own counters, like cache hits, which are shown along with the metrics.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}    # (key, stage):Histogram
+        self.errors = {}        # (key, stage):number of errors
+        self.gauges = {}        # name:function returns dict
+        self.started = time.time()
+        self.logger = Logger("Metrics")
+
+    def observe(self, key, stage, seconds, error=False):
+        "Record one request of the key at the stage, took seconds"
+        with self.lock:
+            histogram = self.histograms.get((key, stage))
+            if histogram is None:
+                histogram = self.histograms[(key, stage)] = Histogram()
+            histogram.add(seconds)
+            if error:
+                self.errors[(key, stage)] = \
+                    self.errors.get((key, stage), 0) + 1
+
+    @contextmanager
+    def timer(self, key, stage):
+        """
+        Time the code in the with block, it is an error if an exception is
+        raised. It is also recorded as a span of the current trace:
+            with metrics.timer("stock", "upstream"):
+                ...
+        """
+        start = time.perf_counter()
+        try:
+            with tracer.span(stage, key=key):
+                yield
+        except BaseException:
+            self.observe(key, stage, time.perf_counter() - start, True)
+            raise
+        self.observe(key, stage, time.perf_counter() - start)
+
+    def gauge(self, name, function):
+        "Add function that returns a dict of counters, shown with the name"
+        with self.lock:
+            self.gauges[name] = function
+
+    def snapshot(self):
+        "Return all the metrics in dict"
+        with self.lock:
+            stages = []
+            for (key, stage), h in sorted(self.histograms.items()):
+                stages.append({
+                    "key": key,
+                    "stage": stage,
+                    "count": h.count,
+                    "errors": self.errors.get((key, stage), 0),
+                    "mean": h.mean(),
+                    "p50": h.percentile(50),
+                    "p95": h.percentile(95),
+                    "p99": h.percentile(99),
+                    "max": h.max,
+                })
+            gauges = list(self.gauges.items())
+        result = {"time": time.time(), "uptime": time.time() - self.started,
+                  "stages": stages, "gauges": {}}
+        for name, function in gauges:
+            try:
+                result["gauges"][name] = function()
+            except Exception as e:
+                result["gauges"][name] = {"error": repr(e)}
+        return result
+
+    def summary(self):
+        "Return the metrics in a short text that can be sent in a message"
+        snapshot = self.snapshot()
+        lines = ["Uptime: " + str(int(snapshot["uptime"])) + "s"]
+        for s in snapshot["stages"]:
+            lines.append(s["key"] + "/" + s["stage"] + ": " +
+                         str(s["count"]) + " requests, " +
+                         str(s["errors"]) + " errors, p50 " +
+                         _ms(s["p50"]) + ", p95 " + _ms(s["p95"]) +
+                         ", p99 " + _ms(s["p99"]))
+        for name, values in snapshot["gauges"].items():
+            lines.append(name + ": " + ", ".join(
+                k + " " + str(v) for k, v in values.items()))
+        return "\n".join(lines)
+
+    def reset(self):
+        "Remove all the recorded requests, gauges are kept"
+        with self.lock:
+            self.histograms = {}
+            self.errors = {}
+            self.started = time.time()
+
+    def dump(self, path):
+        "Write the snapshot to path as json, atomically"
+        temp = path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(temp, path)
+
+    def start_dump(self, path, interval=60):
+        "Dump the snapshot to path every interval seconds in background"
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(path)
+                except OSError as e:
+                    self.logger.error("Failed to dump metrics: %r", e)
+        thread = threading.Thread(target=loop, daemon=True,
+                                  name="MetricsDump")
+        thread.start()
+        return thread
+
+
+def _ms(seconds):
+    "Format seconds in milliseconds"
+    return str(round(seconds * 1000, 1)) + "ms"
+
+
+# The metrics shared by wechatbot and all responders
+metrics = Metrics()
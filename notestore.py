@@ -0,0 +1,320 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from logger import *
+
+# Chinese, Japanese and Korean characters, they are not separated by spaces
+cjk_chars = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+term_pattern = re.compile("[" + cjk_chars + "]+|(?:(?![" + cjk_chars +
+                          "])[^\\W_])+")
+cjk_pattern = re.compile("[" + cjk_chars + "]")
+
+def tokenize(text):
+    """
+    Return the search terms of the text in a list. Words are split by
+    spaces and punctuations in lower case. Runs of CJK characters have no
+    spaces, so they are split into bigrams, every two characters next to
+    each other, a single character is kept as it is. For instance,
+    'Buy 牛奶和面包' gives ['buy', '牛奶', '奶和', '和面', '面包']
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    terms = []
+    for run in term_pattern.findall(text):
+        if len(run) > 1 and is_cjk(run[0]):
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            terms.append(run)
+    return terms
+
+def index_terms(text):
+    """
+    Return the set of terms a note is indexed by, the terms of tokenize()
+    and every single CJK character, so one character can be searched too
+    """
+    terms = set(tokenize(text))
+    for term in list(terms):
+        if is_cjk(term[0]):
+            terms.update(term)
+    return terms
+
+def is_cjk(char):
+    "Return True if the character is a CJK character"
+    return cjk_pattern.match(char) is not None
+
+
+class NoteStore(ABC):
+    """
+    The parent class of all note storage backends. Notes are stored by the
+    puid of their owner, and each user's notes keep the order they were
+    added in. The index of a note is its position in that order, starts
+    from 0, which is the index users see in `note show all`.
+    A backend only needs to touch the records of the given user, it should
+    never load or rewrite the notes of other users.
+    """
+    @abstractmethod
+    def add(self, puid, note):
+        "Append note to the end of user's notes"
+
+    @abstractmethod
+    def get(self, puid, index):
+        "Return the note at index, None if it does not exist"
+
+    @abstractmethod
+    def all(self, puid):
+        "Return a list of all the notes of the user, empty if there is none"
+
+    @abstractmethod
+    def count(self, puid):
+        "Return the number of notes the user has saved"
+
+    @abstractmethod
+    def delete(self, puid, index):
+        "Delete the note at index, return True if deleted, False otherwise"
+
+    @abstractmethod
+    def delete_all(self, puid):
+        "Delete all the notes of the user, return the number of deleted notes"
+
+    @abstractmethod
+    def update(self, puid, index, note):
+        "Replace the note at index, return True if updated, False otherwise"
+
+    def slice(self, puid, start, count):
+        """
+        Return a list of at most count notes from index start. This reads
+        all the notes of the user, backends should only read the slice
+        """
+        return self.all(puid)[start:start + count]
+
+    def search(self, puid, query, limit=20):
+        """
+        Return (total, [(index, note)]) of the notes that have all the
+        terms in query, at most limit notes in the order they were added.
+        Words in query also match words that start with them. This reads
+        all the notes of the user, backends should use an index instead
+        """
+        terms = tokenize(query)
+        if not terms:
+            return 0, []
+        found = []
+        for index, note in enumerate(self.all(puid)):
+            words = index_terms(note)
+            if all(self._matches(term, words) for term in terms):
+                found.append((index, note))
+        return len(found), found[:limit]
+
+    def _matches(self, term, words):
+        "Return True if term is in words, or a prefix of one if not CJK"
+        if term in words:
+            return True
+        if is_cjk(term[0]):
+            return False
+        return any(word.startswith(term) for word in words)
+
+
+class SQLiteNoteStore(NoteStore):
+    """
+    NoteStore that keeps notes in a SQLite database. Notes are indexed
+    by (puid, id), so every operation only reads the rows of one user.
+    On first start, the notes in the legacy json file will be imported.
+    Table note_terms is an inverted index from (puid, term) to the notes
+    that have the term, it is updated with every change of a note, so a
+    search only reads the index entries of its terms.
+    """
+    def __init__(self, path="resources/user_notes.db",
+                 legacy_path="resources/user_notes.json"):
+        """
+        Param: path: The path of the SQLite database file
+        Param: legacy_path: The json file that used to store all the notes,
+            it will be imported once if it exists
+        """
+        self.logger = Logger("SQLiteNoteStore")
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS notes ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "puid TEXT NOT NULL, "
+                "content TEXT NOT NULL)")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS notes_puid ON notes (puid, id)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta ("
+                "key TEXT PRIMARY KEY, value TEXT)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS note_terms ("
+                "puid TEXT NOT NULL, "
+                "term TEXT NOT NULL, "
+                "note_id INTEGER NOT NULL, "
+                "PRIMARY KEY (puid, term, note_id)) WITHOUT ROWID")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS note_terms_note "
+                "ON note_terms (note_id)")
+        self._import_legacy(legacy_path)
+        self._build_index()
+
+    def add(self, puid, note):
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO notes (puid, content) VALUES (?, ?)",
+                (puid, note))
+            self._index(puid, cursor.lastrowid, note)
+
+    def get(self, puid, index):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT content FROM notes WHERE puid = ? "
+                "ORDER BY id LIMIT 1 OFFSET ?", (puid, index)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def all(self, puid):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT content FROM notes WHERE puid = ? ORDER BY id",
+                (puid,)).fetchall()
+        return [row[0] for row in rows]
+
+    def slice(self, puid, start, count):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT content FROM notes WHERE puid = ? "
+                "ORDER BY id LIMIT ? OFFSET ?",
+                (puid, count, start)).fetchall()
+        return [row[0] for row in rows]
+
+    def count(self, puid):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT COUNT(*) FROM notes WHERE puid = ?",
+                (puid,)).fetchone()
+        return row[0]
+
+    def delete(self, puid, index):
+        with self.lock, self.conn:
+            note_id = self._note_id(puid, index)
+            if note_id is None:
+                return False
+            self.conn.execute("DELETE FROM notes WHERE id = ?", (note_id,))
+            self.conn.execute(
+                "DELETE FROM note_terms WHERE note_id = ?", (note_id,))
+        return True
+
+    def delete_all(self, puid):
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "DELETE FROM notes WHERE puid = ?", (puid,))
+            self.conn.execute(
+                "DELETE FROM note_terms WHERE puid = ?", (puid,))
+        return cursor.rowcount
+
+    def update(self, puid, index, note):
+        with self.lock, self.conn:
+            note_id = self._note_id(puid, index)
+            if note_id is None:
+                return False
+            self.conn.execute(
+                "UPDATE notes SET content = ? WHERE id = ?", (note, note_id))
+            self.conn.execute(
+                "DELETE FROM note_terms WHERE note_id = ?", (note_id,))
+            self._index(puid, note_id, note)
+        return True
+
+    def search(self, puid, query, limit=20):
+        terms = list(OrderedDict.fromkeys(tokenize(query)))
+        if not terms:
+            return 0, []
+        # One select of note ids for each term, and only the ids that
+        # every select returns are kept
+        selects = []
+        params = []
+        for term in terms:
+            if is_cjk(term[0]):
+                selects.append("SELECT note_id FROM note_terms "
+                               "WHERE puid = ? AND term = ?")
+                params += [puid, term]
+            else:
+                # Words also match the words that start with them
+                selects.append("SELECT note_id FROM note_terms "
+                               "WHERE puid = ? AND term >= ? AND term < ?")
+                params += [puid, term, term + "\U0010ffff"]
+        matched = " INTERSECT ".join(selects)
+        with self.lock:
+            total = self.conn.execute(
+                "SELECT COUNT(*) FROM (" + matched + ")", params).fetchone()[0]
+            # The index of every note is numbered in one pass over the
+            # notes of the user, instead of counting the notes before each
+            rows = self.conn.execute(
+                "SELECT position, content FROM ("
+                "SELECT id, content, ROW_NUMBER() OVER (ORDER BY id) - 1 "
+                "AS position FROM notes WHERE puid = ?) "
+                "WHERE id IN (" + matched + ") "
+                "ORDER BY id LIMIT ?", [puid] + params + [limit]).fetchall()
+        return total, [(row[0], row[1]) for row in rows]
+
+    def _note_id(self, puid, index):
+        "Return the id of the note at index, must hold the lock"
+        row = self.conn.execute(
+            "SELECT id FROM notes WHERE puid = ? ORDER BY id LIMIT 1 OFFSET ?",
+            (puid, index)).fetchone()
+        return None if row is None else row[0]
+
+    def _index(self, puid, note_id, note):
+        "Add the terms of the note to note_terms, must hold the lock"
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO note_terms (puid, term, note_id) "
+            "VALUES (?, ?, ?)",
+            [(puid, term, note_id) for term in index_terms(note)])
+
+    def _build_index(self):
+        "Index the notes saved before note_terms existed, only happens once"
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM meta WHERE key = 'terms_indexed'"
+            ).fetchone()
+            if row is not None:
+                return
+            self.logger.log("Building search index of notes")
+            with self.conn:
+                self.conn.execute("DELETE FROM note_terms")
+                count = 0
+                for puid, note_id, note in self.conn.execute(
+                        "SELECT puid, id, content FROM notes").fetchall():
+                    self._index(puid, note_id, note)
+                    count += 1
+                self.conn.execute(
+                    "INSERT INTO meta (key, value) VALUES "
+                    "('terms_indexed', '1')")
+        self.logger.log("Indexed %d notes", count)
+
+    def _import_legacy(self, legacy_path):
+        "Import the legacy json notes file, only happens once"
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM meta WHERE key = 'legacy_imported'"
+            ).fetchone()
+        if row is not None or not os.path.exists(legacy_path):
+            return
+        self.logger.log("Importing notes from '%s'", legacy_path)
+        with open(legacy_path, "r") as f:
+            data = json.load(f)
+        rows = [(puid, note) for puid, notes in data.items() for note in notes]
+        with self.lock, self.conn:
+            for puid, note in rows:
+                cursor = self.conn.execute(
+                    "INSERT INTO notes (puid, content) VALUES (?, ?)",
+                    (puid, note))
+                self._index(puid, cursor.lastrowid, note)
+            self.conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('legacy_imported', ?)",
+                (legacy_path,))
+        self.logger.log("Imported %d notes", len(rows))
@@ -0,0 +1,68 @@
+class MessageFilter():
+    """
+    MessageFilter is the first check of every message, it drops the ones
+    that are not requests before anything else is done with them, such as
+    logging or formatting the sender. A request starts with one of the
+    keywords, or with trigger if it is given. In group chats, where most
+    messages are chatter, a request must also mention the bot or start
+    with trigger, and group chats are only accepted if groups is True.
+    """
+    # Characters WeChat puts after a mention, such as '@bot help'
+    mention_ends = ("\u2005", " ")
+
+    def __init__(self, keywords, trigger=None, groups=False):
+        """
+        Param: keywords: The words that start a request, a set
+        Param: trigger: Prefix that every request must start with, such as
+            '@bot', None to accept requests that start with a keyword
+        Param: groups: True to accept requests in group chats
+        """
+        self.keywords = frozenset(keywords)
+        self.trigger = trigger
+        self.groups = groups
+        self.accepted = 0
+        self.dropped = 0
+
+    def accept(self, msg):
+        """
+        Return (user, text) of the message if it is a request, None if not.
+        user is the sender, or the group member who sent it, and text is
+        the request without the trigger or mention
+        """
+        text = msg.text
+        member = getattr(msg, "member", None)
+        if member is not None:
+            text = self._group_text(msg, text)
+        elif self.trigger is not None:
+            text = self._strip(text, self.trigger)
+        if text is None or text.partition(" ")[0] not in self.keywords:
+            self.dropped += 1
+            return None
+        self.accepted += 1
+        return (member or msg.sender), text
+
+    def stats(self):
+        "Return the counters in dict"
+        return {"accepted": self.accepted, "dropped": self.dropped}
+
+    def _group_text(self, msg, text):
+        "Return the request text in a group message, None if not a request"
+        if not self.groups:
+            return None
+        if self.trigger is not None and text.startswith(self.trigger):
+            return self._strip(text, self.trigger)
+        if not getattr(msg, "is_at", False) or not text.startswith("@"):
+            return None
+        # Remove the mention, the name may have spaces but not the
+        # character after the mention
+        for end in self.mention_ends:
+            index = text.find(end)
+            if index > 0:
+                return text[index + 1:].lstrip()
+        return None
+
+    def _strip(self, text, prefix):
+        "Return text without prefix, None if it does not start with it"
+        if not text.startswith(prefix):
+            return None
+        return text[len(prefix):].lstrip()
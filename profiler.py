@@ -0,0 +1,202 @@
+import cProfile
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from logger import *
+
+class Profiler():
+    """
+    Profiler finds where the time and memory go in the running bot. When
+    it is on, every Nth request is run under cProfile, and the profiles are
+    added up by responder and saved to '<key>.prof' files, which can be
+    read with pstats. It also traces memory allocations with tracemalloc,
+    and saves the difference between two snapshots every interval seconds,
+    only the last max_diffs are kept. tracemalloc is only started and
+    stopped by the profiler if nothing else was tracing already.
+    cProfile only sees the thread it runs in, so the work a request hands
+    to other threads, such as the stock fan out or translate batches, is
+    not in the profiles, only the time waiting for it.
+    It is off by default and can be turned on and off at any time.
+    """
+    def __init__(self, path="resources/profiles", interval=60, top=10,
+                 max_diffs=60):
+        """
+        Param: path: The folder the profiles and memory diffs are saved to
+        Param: interval: Seconds between two saves and memory snapshots
+        Param: top: Number of functions or lines in summaries and diffs
+        Param: max_diffs: Number of memory diff files kept
+        """
+        self.path = path
+        self.interval = interval
+        self.top = top
+        self.max_diffs = max_diffs
+        self.lock = threading.Lock()
+        # Only one cProfile can run at a time
+        self.running = threading.Lock()
+        # stop() and the background thread may save at the same time
+        self.saving = threading.Lock()
+        self.enabled = False
+        self.every = 10
+        self.count = 0
+        self.stats = {}         # key:pstats.Stats
+        self.samples = {}       # key:number of requests profiled
+        self.changed = set()    # keys profiled since the last save
+        self.snapshot = None
+        # True if the profiler started tracemalloc and should stop it
+        self.traces_memory = False
+        self.memory_diff = []   # lines of the last memory diff
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.logger = Logger("Profiler")
+
+    def start(self, every=10):
+        "Turn on profiling, profile one in every requests"
+        with self.lock:
+            self.every = max(1, every)
+            if self.enabled:
+                return
+            self.enabled = True
+            self.count = 0
+            self.stop_event.clear()
+            self.traces_memory = not tracemalloc.is_tracing()
+            if self.traces_memory:
+                tracemalloc.start()
+            self.snapshot = tracemalloc.take_snapshot()
+            self.thread = threading.Thread(target=self._loop, daemon=True,
+                                           name="Profiler")
+            self.thread.start()
+        self.logger.log("Profiling one in %d requests", self.every)
+
+    def stop(self):
+        "Turn off profiling, save the profiles and memory diff"
+        with self.lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+            self.stop_event.set()
+        self._save()
+        if self.traces_memory:
+            tracemalloc.stop()
+            self.traces_memory = False
+        self.snapshot = None
+        self.logger.log("Profiling stopped")
+
+    def reset(self):
+        "Remove the profiles collected so far"
+        with self.lock:
+            self.stats = {}
+            self.samples = {}
+            self.changed = set()
+            self.memory_diff = []
+
+    @contextmanager
+    def profile(self, key):
+        """
+        Profile the with block if profiling is on and it is the Nth
+        request, add the profile to the profiles of key
+        """
+        if not self.enabled:
+            yield
+            return
+        with self.lock:
+            self.count += 1
+            sampled = self.count % self.every == 0
+        if not sampled or not self.running.acquire(blocking=False):
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+        finally:
+            self.running.release()
+            self._add(key, profile)
+
+    def summary(self):
+        "Return the slowest functions of each responder and the memory diff"
+        lines = ["Profiling: " + ("on, one in " + str(self.every) +
+                                  " requests" if self.enabled else "off")]
+        with self.lock:
+            stats = dict(self.stats)
+            samples = dict(self.samples)
+            memory_diff = list(self.memory_diff)
+        for key in sorted(stats):
+            lines.append("")
+            lines.append(key + ": " + str(samples[key]) + " requests")
+            entries = sorted(stats[key].stats.items(),
+                             key=lambda item: item[1][3], reverse=True)
+            for (file, line, func), (_, calls, _, cumtime, _) in \
+                    entries[:self.top]:
+                lines.append("  " + str(round(cumtime * 1000 /
+                                              samples[key], 2)) +
+                             "ms " + func + " " + os.path.basename(file) +
+                             ":" + str(line) + " x" + str(calls))
+        if memory_diff:
+            lines.append("")
+            lines.append("Memory since last snapshot:")
+            lines.extend("  " + line for line in memory_diff)
+        return "\n".join(lines)
+
+    def _add(self, key, profile):
+        "Add the profile to the profiles of key"
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                self.stats[key] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            self.samples[key] = self.samples.get(key, 0) + 1
+            self.changed.add(key)
+
+    def _loop(self):
+        "Save the profiles and take memory snapshots until stopped"
+        while not self.stop_event.wait(self.interval):
+            try:
+                self._save()
+            except Exception as e:
+                self.logger.error("Failed to save profiles: %r", e)
+
+    def _save(self):
+        "Save the changed profiles and the memory diff since last time"
+        with self.saving:
+            self._save_locked()
+
+    def _save_locked(self):
+        "Save the profiles and memory diff, must hold saving"
+        os.makedirs(self.path, exist_ok=True)
+        with self.lock:
+            changed = [(key, self.stats[key]) for key in self.changed]
+            self.changed = set()
+        for key, stats in changed:
+            with self.lock:
+                stats.dump_stats(os.path.join(self.path, key + ".prof"))
+        if not tracemalloc.is_tracing() or self.snapshot is None:
+            return
+        # Leave out the allocations of the profiler itself
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, pstats.__file__)))
+        diff = snapshot.compare_to(self.snapshot, "lineno")[:self.top]
+        self.snapshot = snapshot
+        lines = [str(stat) for stat in diff]
+        with self.lock:
+            self.memory_diff = lines
+        name = "memory-" + time.strftime("%Y%m%d-%H%M%S") + ".txt"
+        with open(os.path.join(self.path, name), "w") as f:
+            f.write("\n".join(lines) + "\n")
+        # The names sort by time, remove the oldest diffs
+        diffs = sorted(file for file in os.listdir(self.path)
+                       if file.startswith("memory-") and file.endswith(".txt"))
+        for file in diffs[:max(0, len(diffs) - self.max_diffs)]:
+            os.remove(os.path.join(self.path, file))
+
+
+# The profiler of the bot, off until it is started
+profiler = Profiler()
@@ -0,0 +1,65 @@
+import threading
+import time
+
+class TokenBucket():
+    """
+    Token bucket rate limiter. It holds at most capacity tokens and gains
+    rate tokens per second, every action takes tokens from it. Thread safe.
+    """
+    def __init__(self, rate, capacity):
+        """
+        Param: rate: Tokens added per second
+        Param: capacity: Max number of tokens, also the tokens at start
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self, tokens=1):
+        "Take tokens if there are enough, return True if taken"
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1, timeout=None):
+        """
+        Wait until there are enough tokens and take them, return True if
+        taken, False if timeout seconds passed first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return True
+                wait = (tokens - self.tokens) / self.rate
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                wait = min(wait, left)
+            time.sleep(wait)
+
+    def refund(self, tokens=1):
+        "Give back tokens that were taken but not used"
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + tokens)
+
+    def available(self):
+        "Return the number of tokens now"
+        with self.lock:
+            self._refill()
+            return self.tokens
+
+    def _refill(self):
+        "Add the tokens gained since last refill, must hold the lock"
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
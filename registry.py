@@ -0,0 +1,109 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+from logger import *
+from metrics import *
+
+class LazyResponder():
+    """
+    LazyResponder stands for a responder that is not created yet. It gives
+    the keyword, actions and aliases from the class attributes of the
+    responder, and only creates the responder when the first request
+    needs to be handled.
+    """
+    def __init__(self, cls):
+        "Param: cls: The responder class, must set class attribute keyword"
+        self.cls = cls
+        self.instance = None
+        self.lock = threading.Lock()
+        self.cost = cls.cost
+
+    def key(self):
+        return self.cls.keyword
+
+    def is_complex(self):
+        return self.cls.complex
+
+    def actions(self):
+        return self.cls.action_names
+
+    def aliases(self):
+        return self.cls.alias_names
+
+    def action_aliases(self):
+        return self.cls.action_alias_names
+
+    def accepts_detail(self, detail=None):
+        if not self.cls.takes_detail:
+            return False
+        return detail is None or self.cls.detail_pattern is None or \
+                re.fullmatch(self.cls.detail_pattern, detail) is not None
+
+    def get(self):
+        "Return the responder, create it if it is not created yet"
+        if self.instance is None:
+            with self.lock:
+                if self.instance is None:
+                    start = time.perf_counter()
+                    self.instance = self.cls()
+                    metrics.observe(self.key(), "create",
+                                    time.perf_counter() - start)
+        return self.instance
+
+    def handle(self, request):
+        return self.get().handle(request)
+
+
+def load_responders(classes):
+    """
+    Return the responders of the given classes. Classes that set class
+    attribute keyword are loaded lazily as LazyResponder, the others are
+    created right away since their keyword is only known from key()
+    """
+    logger = Logger("Registry")
+    responders = []
+    for cls in classes:
+        if cls.keyword is not None:
+            responders.append(LazyResponder(cls))
+            continue
+        start = time.perf_counter()
+        r = cls()
+        metrics.observe(r.key(), "create", time.perf_counter() - start)
+        responders.append(r)
+    logger.log("Loaded %d responders", len(responders))
+    return responders
+
+
+class StartupTimer():
+    """
+    StartupTimer records how long each phase of starting the bot took:
+        with startup.phase("login"):
+            ...
+    """
+    def __init__(self, started=None):
+        "Param: started: perf_counter() when the start began, now if None"
+        self.started = time.perf_counter() if started is None else started
+        self.last = self.started
+        self.phases = []    # [(name, seconds)]
+
+    def mark(self, name):
+        "Record the time since the last phase as phase name"
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    @contextmanager
+    def phase(self, name):
+        "Record the time in the with block as phase name"
+        self.last = time.perf_counter()
+        yield
+        self.mark(name)
+
+    def report(self):
+        "Return the phases in a list of lines, with the total time"
+        lines = [name + ": " + str(round(seconds * 1000, 1)) + "ms"
+                 for name, seconds in self.phases]
+        lines.append("total: " + str(round(
+            (self.last - self.started) * 1000, 1)) + "ms")
+        return lines
@@ -1,11 +1,54 @@
 import time
-import urllib.request
 import json
 import os
 import datetime
+import urllib.parse
+import threading
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from logger import *
-from abc import ABC, abstractmethod
-from google.cloud import translate
+from notestore import *
+from httpclient import *
+from cache import *
+from diskcache import *
+from barstore import *
+from alerts import *
+from profiler import *
+from translation import *
+from metrics import *
+from upstream import *
+from tracer import tracer
+from abc import ABC
+
+class Request():
+    """
+    Request holds everything about a single request sent by a user. A new
+    Request is created for every message, so responders that only read the
+    request state from it can handle requests from many users at once.
+    """
+    def __init__(self, puid, key, action=None, detail=None, admin=False):
+        """
+        Param: puid: The unique id of the user who sent the request
+        Param: key: The keyword of the request
+        Param: action: The action of a complex request, None if simple
+        Param: detail: The detail after the action, None if simple
+        Param: admin: True if the user is an admin of the bot
+        """
+        self.puid = puid
+        self.key = key
+        self.action = action
+        self.detail = detail
+        self.admin = admin
+        self._args = None
+
+    @property
+    def args(self):
+        "The words in detail, split by spaces"
+        if self._args is None:
+            self._args = self.detail.split() if self.detail else []
+        return self._args
+
 
 class Responder(ABC):
     """
@@ -13,194 +56,291 @@ class Responder(ABC):
     to create instance of the reponder by reflection. The responder that
     did not inherit this class will not be accessible.
     All responders should not have any arguments in constructor.
-    All responders need to implement method key()
-    All responders need to implement method respond()
-    All responders need to implement method is_complex()
-    method receive() is optional and only useful when handling complex request
+    All responders need to set class attribute keyword, or implement
+    method key()
+    All responders need to set class attribute complex, or implement
+    method is_complex()
+    All responders need to implement either handle() or respond()
+    The other class attributes are optional. If the responder gives its
+    keyword as class attributes, wechatbot only creates the responder when
+    the first request of it arrives, otherwise it is created at start
+    method handle() receives a Request and should not store it on self, so
+    the same responder can handle concurrent requests
+    method receive() and respond() are the old way to handle requests, they
+    still work but the requests will be handled one at a time
     method actions() is optional and only useful when handling complex request
+    method aliases() and action_aliases() are optional, they give other
+    names of the keyword and actions
     It is recommended to use logger to keep track of requests and responds
     """
-    @abstractmethod
+    # The keyword, returned by key()
+    keyword = None
+    # True if it handles complex requests, returned by is_complex()
+    complex = False
+    # The actions of complex requests, returned by actions()
+    action_names = ()
+    # Other keywords, returned by aliases()
+    alias_names = ()
+    # Other names of actions in 'alias':'action' format, returned by
+    # action_aliases()
+    action_alias_names = {}
+    # True if simple request can be followed by detail, returned by
+    # accepts_detail()
+    takes_detail = False
+    # Regular expression the whole detail of a simple request must match,
+    # None to accept any detail
+    detail_pattern = None
+    # Tokens a request takes from the rate limits of the user and the bot,
+    # higher for responders that use a limited upstream quota
+    cost = 1
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Every responder class has its own lock for the receive() and
+        # respond() compatibility shim in handle()
+        cls._shim_lock = threading.Lock()
+
     def key(self):
         "return keyword corresponding to this responder"
+        return self.keyword
+
+    def is_complex(self):
+        "return True if it can handle compelx reqeust, False otherwise"
+        return self.complex
+
+    def handle(self, request):
+        """
+        return respond to the given Request that will send to user, in str
+        format, return None if the request is not valid
+        By default, it passes the request to receive() and then calls
+        respond(), while holding a lock since they keep state on self.
+        Override this method to handle requests concurrently
+        """
+        with self._shim_lock:
+            if self.is_complex():
+                self.receive(request.puid, request.action, request.detail)
+            return self.respond()
 
-    @abstractmethod
     def respond(self):
         """
         return respond that will send to user, in str format
         return None if the request is not valid
+        Only used by the default handle(), new responders override handle()
         """
 
-    @abstractmethod
-    def is_complex(self):
-        "return True if it can handle compelx reqeust, False otherwise"
-
     def receive(self, puid, action, detail):
         "let this responder to receive user puid and an action with detail"
 
     def actions(self):
         "return a list of actions that this responder can handle"
+        return self.action_names
+
+    def aliases(self):
+        "return a list of other keywords of this responder"
+        return self.alias_names
+
+    def action_aliases(self):
+        "return a dict of other names of actions, in 'alias':'action' format"
+        return self.action_alias_names
+
+    def accepts_detail(self, detail=None):
+        """
+        return True if a simple request can be followed by a detail, such as
+        'weather toronto', False otherwise. If detail is given, also return
+        False if it does not match detail_pattern
+        """
+        if not self.takes_detail:
+            return False
+        return detail is None or self.detail_pattern is None or \
+                re.fullmatch(self.detail_pattern, detail) is not None
 
 
 class WeatherResponder(Responder):
-    "WeatherResponsder retrieve informations from OpenWeatherMap."
+    """
+    WeatherResponsder retrieve informations from OpenWeatherMap. Users can
+    send 'weather [city]' for any city, or 'weather' for the default city.
+    The weather of each city is cached in memory for ten mins, after that
+    the cached one is still returned while it is being updated in
+    background. The cache is saved to the shared response_cache to warm up
+    the next start.
+    """
+    keyword = "weather"
+    takes_detail = True
+    # A city is at most four words without digits, and chatter such as
+    # 'weather is nice today' is not sent to OpenWeatherMap
+    detail_pattern = r"(?i)(?!.*\b(?:is|are|was|were|so|very|really|too|" \
+            r"today|tonight|tomorrow|yesterday|like|looks|seems|feels|" \
+            r"what|how|why|i|it|you|we|my|your|this|that)\b)" \
+            r"\s*[^\W\d_]+(?:[ ,.'-]+[^\W\d_]+){0,3}\.?\s*"
+
     def __init__(self):
         """
         Var: weather_base: The base url of the OpenWeatherMap request
         Var: weather_appid: full weather_appid url
-        Var: weather_city: full weather_city url
+        Var: weather_city: full weather_city url of the default city
         Var: weather_unit: full weather_unit url
-        Var: weather_full_url: The full request url contains all above
-        Var: data: The data in dict format
+        Var: http: The HttpClient that sends requests to OpenWeatherMap
+        Var: upstream: Keeps requests within the OpenWeatherMap quota, and
+            lets requests of the same city share one
+        Var: cache: The weather data of each city
         """
         # The base url of the OpenWeatherMap
         self.weather_base = "http://api.openweathermap.org/data/2.5/weather?"
         # Your own OpenWeatherMap appid
         self.weather_appid = "appid={your_api_key}"
-        # Your city id on openweathermap
+        # Your city id on openweathermap, used when no city is given
         self.weather_city = "id=6167865"
         self.weacher_unit = "units=metric"
-        # The full request url
-        self.weather_full_url = self.weather_base \
-                                + self.weather_city + "&"\
-                                + self.weather_appid + "&"\
-                                + self.weacher_unit
+        self.http = shared_client
+        # The free plan allows 60 calls per minute
+        self.upstream = Upstream("openweathermap", rate=1, burst=60)
+        metrics.gauge("openweathermap", self.upstream.stats)
+        self.cache = SWRCache(self._retrieve_weather, 10 * 60,
+                              response_cache, "weather:",
+                              self._refresh_weather)
+        metrics.gauge("weather cache", self.cache.stats)
+        # Cities OpenWeatherMap does not know, they are not asked again
+        self.not_found = LRUCache(1024, 24 * 60 * 60)
         self.logger = Logger("WeatherResponder")
         self.logger.log("Iniaialized new WeatherResponder")
 
-    def is_complex(self):
-        return False
-
-    def key(self):
-        return "weather"
-
-    def respond(self):
-        data = self._retrieve_weather()
+    def handle(self, request):
+        city = self._city_key(request.detail)
+        if self.not_found.get(city):
+            return "City not found: " + request.detail.strip()
+        try:
+            with tracer.span("cache", key="weather"):
+                data = self.cache.get(city)
+        except HttpError as e:
+            if e.status == 404:
+                self.not_found.put(city, True)
+                return "City not found: " + request.detail.strip()
+            self.logger.error("Failed to retrieve weather: %r", e)
+            return "Failed to retrieve weather, please try again later"
+        except OSError as e:
+            self.logger.error("Failed to retrieve weather: %r", e)
+            return "Failed to retrieve weather, please try again later"
+        except QuotaTimeout:
+            return "Too many requests, please try again later"
         condition = data['weather'][0]['main']
         condition_detail = data['weather'][0]['description']
         temp = str(data['main']['temp'])
         min_temp = str(data['main']['temp_min'])
         max_temp = str(data['main']['temp_max'])
-        return "City: Toronto\n"+\
+        return "City: " + data['name'] + "\n"+\
                 "Current temperature: " + temp + "°C\n"+\
                 "Lowest temperature: " + min_temp + "°C\n" +\
                 "Highest temperature: " + max_temp + "°C\n" +\
                 "Condition: "+condition + "\n" +\
                 "Condition detail: "+condition_detail+"\n"
 
-    def _retrieve_weather(self):
-        """
-        Retrieve the weather informations from OpenWeatherMap. If the last
-        request was in ten mins, return the same result, otherwise, retrieve
-        the new result again
-        """
-        # If it is already ten mins after, retrieve new data
-        if self._over_last_retrieve_time():
-            self.logger.log("Retrieve new weather data")
-            with urllib.request.urlopen(self.weather_full_url) as url:
-                data = json.loads(url.read().decode())
-            self._save_json(data)
-            self._save_last_retrieve_time()
-            return data
-        else:
-            self.logger.log("Using saved weather data")
-            return self._read_json()
-
-    def _read_json(self):
-        "Read the json file"
-        self.logger.log("Reading json 'weather_temp.json'")
-        with self._open_weather_temp("r") as f:
-            data = json.load(f)
-        return data
-
-    def _save_json(self, data):
-        "Save the respond json file to local temp file"
-        self.logger.log("Saving data to json 'weather_temp.json'")
-        with self._open_weather_temp("w") as f:
-            json.dump(data, f)
-
-    def _over_last_retrieve_time(self):
-        "Return True if last retrieve time is over ten mins, false otherwise"
-        # Convert ten mins to seconds
-        ten_mins = 10 * 60
-        # Calculate the difference
-        now = time.time()
-        last = self._get_last_retrieve_time()
-        if now - last > ten_mins:
-            return True
-        return False
+    def _city_key(self, detail):
+        "Return the cache key of the city, the city in lower case"
+        if detail is None or len(detail.strip()) == 0:
+            return ""
+        return " ".join(detail.lower().split())
 
-    def _save_last_retrieve_time(self):
-        "Save current time as last retrieve time, usually save after requesting"
-        self.logger.log("Updaed last retrieved time in 'weather_retrieve_time'")
-        with self._open_weather_retrieve_time("w") as f:
-            f.write(str(time.time()))
+    def _full_url(self, city):
+        "Return the full request url of the city, default city if empty"
+        if city == "":
+            location = self.weather_city
+        else:
+            location = "q=" + urllib.parse.quote(city)
+        return self.weather_base + location + "&"\
+                + self.weather_appid + "&"\
+                + self.weacher_unit
 
-    def _get_last_retrieve_time(self):
-        "Get last retrieve time as float"
-        with self._open_weather_retrieve_time("r") as f:
-            time = float(f.readline())
-        return time
+    def _retrieve_weather(self, city, priority=INTERACTIVE):
+        "Retrieve the weather informations of the city from OpenWeatherMap"
+        return self.upstream.fetch(city, lambda: self._download(city),
+                                   priority)
 
-    def _open_weather_temp(self, mode):
-        "Return opened file, remember to close"
-        return open("resources/weather_temp.json", mode)
+    def _refresh_weather(self, city):
+        "Retrieve the weather of the city for a background refresh"
+        return self._retrieve_weather(city, BACKGROUND)
 
-    def _open_weather_retrieve_time(self, mode):
-        "Return opened file, remember to close"
-        return open("resources/weather_retrieve_time", mode)
+    def _download(self, city):
+        "Send the request to OpenWeatherMap"
+        self.logger.log("Retrieve new weather data")
+        with metrics.timer("weather", "upstream"):
+            return self.http.get_json(self._full_url(city))
 
 
 class HelpResponder(Responder):
-    "HelpResponder return str that help users to use the bot"
+    """
+    HelpResponder return the sections of the help message that help users
+    to use the bot, they are sent in as few messages as they fit in
+    """
+    keyword = "help"
+    # The help message, each section is sent as a whole
+    sections = (
+        "WechatBot receives requests and responds to them. The "+\
+            "requests must strictly follow the syntax as shown below.\n" +\
+            "Here are all the keywords. The following informations are "+\
+            "in 'keyword': explaination format\n\n",
+        "'weather': Get the real-time weather informations\n\n",
+        "'weather [city]': Get the real-time weather informations " +\
+            "of the given city\n\n",
+        "'note add [youtnotes]': Add notes and bot will save it. " +\
+            "Notes have their own indices, first will be 0 and "+\
+            "continue to increase as more notes being saved\n\n",
+        "'note show [index]': View note by index, starts from 0. " +\
+            "If the note does not exist, will respond 'No note " +\
+            "found by the given index'\n\n",
+        "'note show all': View all the notes you've saved "+\
+            "in the bot. In format: index: [younotes]. " +\
+            "Respond 'No notes found' If there is no note saved\n\n",
+        "'note show page [page]': View the notes you've saved " +\
+            "ten at a time, page starts from 1\n\n",
+        "'note del [index]': Delete note by its index, if the note " +\
+            "does not exist, will respond 'No note found by the " +\
+            "given index'\n\n",
+        "'note del all': Delete all the notes you have saved\n\n",
+        "'note search [words]': Find the notes that have all the " +\
+            "words, in format: index: [yournotes]. Chinese " +\
+            "works as well\n\n",
+        "'note update [index] [yournotes]': Update the note that " +\
+            "you have saved by the given index. Will respond " +\
+            "'No note found by the given index' if the note " +\
+            "does not exist\n\n",
+        "'stock track [stock symbol]': Get the real-time stock " +\
+            "informations by its symbol. Several symbols separated " +\
+            "by spaces can be tracked at once, for instance " +\
+            "'stock track AAPL MSFT'. Please notice that if the " +\
+            "stock market is closed today, it will return " +\
+            "'Stock market closed, no data given'\n\n",
+        "'stock history [date] [stock symbol]': Get the history " +\
+            "stock data on a specific date. The date must be in " +\
+            "format 'yyyy-mm-dd'. Several symbols separated by " +\
+            "spaces are accepted as well. And the max date it can " +\
+            "track is four months from today. For instance, if " +\
+            "today is " +\
+            "Aug 1st, the oldest date is Apr 1st. If the stock " +\
+            "market was closed that day, it will return " +\
+            "'Stock market closed on [date], no data given'\n\n",
+        "'stock range [date] [date] [stock symbol]': Get the open, " +\
+            "close, high, low, volume and change of the stock between " +\
+            "the two dates, in format 'yyyy-mm-dd'\n\n",
+        "'stock ma [days] [stock symbol]': Get the moving average " +\
+            "of the close price of the last days\n\n",
+        "'stock change [days] [stock symbol]': Get the percent change " +\
+            "of the last days, and the best and worst day\n\n",
+        "'stock watch [stock symbol] [above/below] [price]': Get a " +\
+            "message when the price goes above or below the given " +\
+            "price. 'stock watch list' shows your watches and " +\
+            "'stock unwatch [id]' removes one\n\n",
+        "'translate [lang code] [sentence]': Translate the " +\
+            "given sentence to the given language. For " +\
+            "[lang code], check out https://sites.google.com/" +\
+            "site/tomihasa/google-language-codes",
+    )
+
     def __init__(self):
         self.logger = Logger("HelpResponder")
         self.logger.log("Iniaialized new HelpResponder")
 
-    def key(self):
-        return "help"
-
-    def is_complex(self):
-        return False
-
-    def respond(self):
-        return "WechatBot receives requests and responds to them. The "+\
-                "requests must strictly follow the syntax as shown below.\n" +\
-                "Here are all the keywords. The following informations are "+\
-                "in 'keyword': explaination format\n\n" +\
-                "'weather': Get the real-time weather informations\n\n" +\
-                "'note add [youtnotes]': Add notes and bot will save it. " +\
-                    "Notes have their own indices, first will be 0 and "+\
-                    "continue to increase as more notes being saved\n\n" +\
-                "'note show [index]': View note by index, starts from 0. " +\
-                    "If the note does not exist, will respond 'No note " +\
-                    "found by the given index'\n\n" +\
-                "'note show all': View all the notes you've saved "+\
-                    "in the bot. In format: index: [younotes]. " +\
-                    "Respond 'No notes found' If there is no note saved\n\n" +\
-                "'note del [index]': Delete note by its index, if the note " +\
-                    "does not exist, will respond 'No note found by the " +\
-                    "given index'\n\n" +\
-                "'note del all': Delete all the notes you have saved\n\n" +\
-                "'note update [index] [yournotes]': Update the note that " +\
-                    "you have saved by the given index. Will respond " +\
-                    "'No note found by the given index' if the note " +\
-                    "does not exist\n\n" +\
-                "'stock track [stock symbol]': Get the real-time stock " +\
-                    "informations by its symbol. Please notice that if the " +\
-                    "stock market is closed today, it will return " +\
-                    "'Stock market closed, no data given'\n\n" +\
-                "'stock history [date] [stock symbol]': Get the history " +\
-                    "stock data on a specific date. The date must be in " +\
-                    "format 'yyyy-mm-dd'. And the max date it can track is " +\
-                    "four months from today. For instance, if today is " +\
-                    "Aug 1st, the oldest date is Apr 1st. If the stock " +\
-                    "market was closed that day, it will return " +\
-                    "'Stock market closed on [date], no data given'\n\n" +\
-                "'translate [lang code] [sentence]': Translate the " +\
-                    "given sentence to the given language. For " +\
-                    "[lang code], check out https://sites.google.com/" +\
-                    "site/tomihasa/google-language-codes"
+    def handle(self, request):
+        return self.sections
 
 
 class NoteResponder(Responder):
@@ -208,106 +348,137 @@ class NoteResponder(Responder):
     Note responder retrieve notes of corresponding user and return them.
     It can also save, delete or modify notes. The notes are saved based
     on the puid that provided by the wxpy.Bot and they are unique. Therefore,
-    each user has separate notes and there are no conflicts between them
+    each user has separate notes and there are no conflicts between them.
+    Notes are kept by a NoteStore, set store_factory to another NoteStore
+    subclass to change the storage backend
     """
+    keyword = "note"
+    complex = True
+    action_names = ("add", "del", "show", "update", "search")
+    action_alias_names = {"delete": "del", "edit": "update", "find": "search"}
+    store_factory = SQLiteNoteStore
+    # Max number of notes shown by a search
+    max_results = 20
+    # Number of notes in a page of 'note show page'
+    page_size = 10
+    # Number of notes read from the store at once by 'note show all'
+    batch_size = 100
+
     def __init__(self):
         self.logger = Logger("NoteResponder")
         self.logger.log("Iniaialized new NoteResponder")
-        self.action = None
-        self.detail = None
-        self.puid = None
+        self.store = self.store_factory()
 
-    def is_complex(self):
-        return True
-
-    def key(self):
-        return "note"
-
-    def respond(self):
-        if self.action == "add":
-            return self.add_respond(self.puid, self.detail)
-        elif self.action == "show":
-            if self.detail == "all":
-                return self.shw_all_respond(self.puid)
-            elif self.detail.isdigit():
-                return self.shw_index_respond(self.puid, self.detail)
-        elif self.action == "del":
-            if self.detail == "all":
-                return self.del_all_respond(self.puid)
-            elif self.detail.isdigit():
-                return self.del_index_respond(self.puid, self.detail)
-        elif self.action == "update":
-            return self.upd_respond(self.puid, self.detail)
-
-    def receive(self, puid, action, detail):
-        self.puid = puid
-        self.action = action
-        self.detail = detail
-
-    def actions(self):
-        return ["add", "del", "show", "update"]
+    def handle(self, request):
+        puid = request.puid
+        action = request.action
+        detail = request.detail
+        if action == "add":
+            return self.add_respond(puid, detail)
+        elif action == "show":
+            if detail == "all":
+                return self.shw_all_respond(puid)
+            elif detail.isdigit():
+                return self.shw_index_respond(puid, detail)
+            elif detail.startswith("page "):
+                return self.shw_page_respond(puid, detail[5:].strip())
+        elif action == "del":
+            if detail == "all":
+                return self.del_all_respond(puid)
+            elif detail.isdigit():
+                return self.del_index_respond(puid, detail)
+        elif action == "update":
+            return self.upd_respond(puid, detail)
+        elif action == "search":
+            return self.search_respond(puid, detail)
 
     def add_respond(self, user_id, note):
         "Save notes and give respond"
-        data = self._read_json()
         if note.isspace():
             return "Note cannot be empty"
-        if user_id not in data:
-            data[user_id] = []
-        data[user_id].append(note)
-        with self._open_notes("w") as f:
-            json.dump(data, f)
+        self.store.add(user_id, note)
         return "Successfully saved your note"
 
     def shw_all_respond(self, user_id):
-        "Show all notes user have saved"
-        data = self._read_json()
-        if user_id not in data:
+        """
+        Show all notes user have saved, the notes are read from the store a
+        batch at a time while the respond is being sent
+        """
+        if self.store.count(user_id) == 0:
             return "No notes found"
-        notes = data[user_id]
-        if len(notes) == 0:
+        return self._iter_notes(user_id)
+
+    def shw_page_respond(self, user_id, page):
+        "Show the notes in page, starts from 1"
+        if not page.isdigit():
+            return None
+        count = self.store.count(user_id)
+        if count == 0:
             return "No notes found"
-        respond = ""
-        for index in range(0, len(notes)):
-            respond += str(index) + ": " + notes[index] + "\n\n"
-        return respond
+        pages = (count + self.page_size - 1) // self.page_size
+        ipage = int(page)
+        if ipage < 1 or ipage > pages:
+            return "Page out of range, should be in [1, " + str(pages) + "]"
+        start = (ipage - 1) * self.page_size
+        notes = self.store.slice(user_id, start, self.page_size)
+        lines = ["Page " + page + " of " + str(pages)]
+        lines.extend(str(start + i) + ": " + note
+                     for i, note in enumerate(notes))
+        if ipage < pages:
+            lines.append("Send 'note show page " + str(ipage + 1) +
+                         "' for more")
+        return "\n\n".join(lines)
+
+    def _iter_notes(self, user_id):
+        "Yield the notes of the user in 'index: note' format"
+        start = 0
+        while True:
+            notes = self.store.slice(user_id, start, self.batch_size)
+            for i, note in enumerate(notes):
+                yield str(start + i) + ": " + note + "\n\n"
+            if len(notes) < self.batch_size:
+                return
+            start += len(notes)
+
+    def search_respond(self, user_id, query):
+        "Show the notes that have all the words in query"
+        if len(query.strip()) == 0:
+            return None
+        total, found = self.store.search(user_id, query, self.max_results)
+        if total == 0:
+            return "No notes found for: " + query
+        lines = [str(index) + ": " + note for index, note in found]
+        respond = "Found " + str(total) + " notes"
+        if total > len(found):
+            respond += ", showing the first " + str(len(found))
+        return respond + "\n\n" + "\n\n".join(lines)
 
     def shw_index_respond(self, user_id, index):
         "Show note by index"
         iindex = int(index)
-        data = self._read_json()
-        if user_id not in data:
-            return "No notes found by given index"
-        notes = data[user_id]
-        if len(notes) == 0:
+        note = self.store.get(user_id, iindex)
+        if note is not None:
+            return note
+        count = self.store.count(user_id)
+        if count == 0:
             return "No notes found"
-        if iindex >= len(notes):
-            return "Index out of range, should be in [0, "+str(len(notes)-1)+"]"
-        return notes[iindex]
+        return "Index out of range, should be in [0, "+str(count-1)+"]"
 
     def del_all_respond(self, user_id):
         "Delete all notes"
-        data = self._read_json()
-        if user_id not in data:
+        if self.store.delete_all(user_id) == 0:
             return "No notes found"
-        data[user_id] = []
-        with self._open_notes("w") as f:
-            json.dump(data, f)
         return "Successfully deleted all the notes"
 
     def del_index_respond(self, user_id, index):
         "Delete note by index"
         iindex = int(index)
-        data = self._read_json()
-        if user_id not in data:
+        if self.store.delete(user_id, iindex):
+            return "Successfully deleted note at index: " + index
+        count = self.store.count(user_id)
+        if count == 0:
             return "No notes found"
-        notes = data[user_id]
-        if iindex >= len(notes):
-            return "Index out of range, should be in [0, "+str(len(notes)-1)+"]"
-        notes.pop(iindex)
-        with self._open_notes("w") as f:
-            json.dump(data, f)
-        return "Successfully deleted note at index: " + index
+        return "Index out of range, should be in [0, "+str(count-1)+"]"
 
     def upd_respond(self, user_id, detail):
         "Update note at index, replace old with new note"
@@ -316,27 +487,13 @@ class NoteResponder(Responder):
         if index.isdigit():
             new_note = " ".join(splitter[1:])
             iindex = int(index)
-            data = self._read_json()
-            if user_id not in data:
+            if self.store.update(user_id, iindex, new_note):
+                return "Successfully updated note at index: " + index
+            count = self.store.count(user_id)
+            if count == 0:
                 return "No notes found"
-            notes = data[user_id]
-            if iindex >= len(notes):
-                return "Index out of range, should be in [0, "+\
-                        str(len(notes)-1)+"]"
-            notes[iindex] = new_note
-            with self._open_notes("w") as f:
-                json.dump(data, f)
-            return "Successfully updated note at index: " + index
-
-    def _read_json(self):
-        "Return the data stores in json file"
-        file = self._open_notes("r")
-        data = json.load(file)
-        file.close()
-        return data
-
-    def _open_notes(self, mode):
-        return open("resources/user_notes.json", mode)
+            return "Index out of range, should be in [0, "+\
+                    str(count-1)+"]"
 
 
 class StockResponder(Responder):
@@ -344,52 +501,184 @@ class StockResponder(Responder):
     StockResponder will respond to user's the real-time stock informations
     based on the symbol that they enetered from alphavantage
     """
+    keyword = "stock"
+    complex = True
+    action_names = ("track", "history", "range", "ma", "change", "watch",
+                    "unwatch")
+    cost = 3
+    # Number of days kept in the cached series, alphavantage gives this
+    # many days unless the full history is requested
+    compact_days = 100
+
     def __init__(self):
         """
-        Param: symbol: The symbol of the stock
         Param: base_url: The base url of the alphavantage website
         Param: function: The function that is requesting
         Param: api_key: Your custom api key
-        Param: data: The data that responded by alphavantage
+        Param: http: The HttpClient that sends requests to alphavantage
+        Param: upstream: Keeps requests within the alphavantage quota, and
+            lets requests of the same symbol share one
+        Param: cache: Cached daily series by symbol, in (data, market date
+            when retrieved) format
+        Param: disk: The DiskCache the series are saved to, so they survive
+            restarts
+        Param: open_ttl: Seconds the cached series lasts while market is
+            open, when closed it lasts until the market opens again
+        Param: market_tz: The timezone of the stock market
+        Param: max_symbols: Max number of symbols in one request
+        Param: max_days: Max number of days of ma and change
+        Param: bars: The BarStore of daily bars used by range, ma and change,
+            None if numpy is not installed
+        Param: alerts: The AlertScheduler that keeps the watches of users
+        Param: executor: Threads that retrieve the symbols of a request
+            concurrently, shared by all requests so the number of requests
+            to alphavantage at the same time is bounded
         """
-        self.detail = None
-        self.symbol = None
         self.base_url = "https://www.alphavantage.co/query?"
         self.function = "function=TIME_SERIES_DAILY"
         self.api_key = "apikey={your_api_key}"
-        self.data = None
-        self.action = None
+        self.http = shared_client
+        # The free plan allows 5 calls per minute
+        self.upstream = Upstream("alphavantage", rate=5 / 60, burst=5)
+        metrics.gauge("alphavantage", self.upstream.stats)
+        self.cache = LRUCache(maxsize=256)
+        metrics.gauge("stock cache", self.cache.stats)
+        self.disk = response_cache
+        self.open_ttl = 5 * 60
+        self.market_tz = self._market_timezone()
+        self.max_symbols = 20
+        self.max_days = 1000
+        self.alerts = stock_alerts
+        self.executor = ThreadPoolExecutor(max_workers=4,
+                                           thread_name_prefix="Stock")
         self.logger = Logger("StockResponder")
+        try:
+            self.bars = BarStore()
+        except ImportError:
+            self.bars = None
+            self.logger.warning("numpy is not installed, stock range, ma "
+                                "and change are turned off")
         self.logger.log("Initialized new StockResponder")
 
-    def key(self):
-        return "stock"
+    def handle(self, request):
+        if request.action == "track":
+            return self.today_respond(request.args)
+        elif request.action == "history":
+            return self.history_respond(request.args)
+        elif request.action == "range":
+            return self.range_respond(request.args)
+        elif request.action == "ma":
+            return self.ma_respond(request.args)
+        elif request.action == "change":
+            return self.change_respond(request.args)
+        elif request.action == "watch":
+            return self.watch_respond(request.puid, request.args)
+        elif request.action == "unwatch":
+            return self.unwatch_respond(request.puid, request.args)
 
-    def actions(self):
-        return ["track", "history"]
+    def watch_respond(self, puid, args):
+        """
+        Respond to stock watch, args are the symbol, above or below and the
+        price, or 'list' to show the watches of the user
+        """
+        if args == ["list"]:
+            watches = self.alerts.list(puid)
+            if not watches:
+                return "No watches found"
+            return "\n".join(str(w) for w in watches)
+        if len(args) != 3 or args[1] not in ("above", "below"):
+            return None
+        try:
+            price = float(args[2])
+        except ValueError:
+            return "Invalid price: " + args[2]
+        # Check the symbol, a watch that never gets a price wastes the quota
+        try:
+            if self.latest_price(args[0], INTERACTIVE) is None:
+                return "Invalid symbol: " + args[0]
+        except QuotaTimeout:
+            return "Too many requests, please try again later"
+        except Exception as e:
+            self.logger.error("Failed to retrieve %s: %r", args[0], e)
+            return "Failed to retrieve data, please try again later"
+        watch = self.alerts.add(puid, args[0], args[1], price)
+        if watch is None:
+            return "Too many watches, at most " +\
+                    str(self.alerts.max_per_user) + " watches"
+        return "Watching " + str(watch) + ", you will be told once " +\
+                "it happens"
 
-    def is_complex(self):
-        return True
+    def unwatch_respond(self, puid, args):
+        "Respond to stock unwatch, args are the id of the watch or 'all'"
+        if args == ["all"]:
+            if self.alerts.remove_all(puid) == 0:
+                return "No watches found"
+            return "Successfully removed all the watches"
+        if len(args) != 1 or not args[0].isdigit():
+            return None
+        if self.alerts.remove(puid, int(args[0])):
+            return "Successfully removed watch: " + args[0]
+        return "No watch found by id: " + args[0]
 
-    def respond(self):
-        if self.action == "track":
-            return self.today_respond()
-        elif self.action == "history":
-            return self.history_respond()
-
-    def history_respond(self):
-        "Respond to history stock"
-        splitter = self.detail.split(" ")
-        if len(splitter) != 2:
+    def latest_price(self, symbol, priority=BACKGROUND):
+        "Return (date, close price) of the last trading day, None if invalid"
+        data = self._retrieve_stock(symbol, priority=priority)
+        if self._function_key() not in data:
             return None
-        date = splitter[0]
-        self.symbol = splitter[1]
+        series = data[self._function_key()]
+        date = max(series)
+        return date, float(series[date]['4. close'])
+
+    def range_respond(self, args):
+        "Respond to stock range, args are the two dates and symbols"
+        if len(args) < 3:
+            return None
+        start, end = args[0], args[1]
+        if not self._valid_date(start) or not self._valid_date(end):
+            return "Invalid date, must be in format yyyy-mm-dd"
+        if start > end:
+            return "The first date must be before the second date"
+        return self._analyze(args[2:],
+                             lambda symbol: self._range(start, end, symbol))
+
+    def ma_respond(self, args):
+        "Respond to moving average, args are the number of days and symbols"
+        days = self._days(args)
+        if isinstance(days, str):
+            return days
+        return self._analyze(args[1:], lambda symbol: self._ma(days, symbol))
+
+    def change_respond(self, args):
+        "Respond to percent change, args are the number of days and symbols"
+        days = self._days(args)
+        if isinstance(days, str):
+            return days
+        return self._analyze(args[1:],
+                             lambda symbol: self._change(days, symbol))
+
+    def history_respond(self, args):
+        "Respond to history stock, args are the date and symbols"
+        if len(args) < 2:
+            return None
+        date = args[0]
         if not self._valid_date(date):
             return "Invalid date, must be in format yyyy-mm-dd"
-        self._retrieve_stock()
-        if self._function_key() not in self.data:
+        return self._fan_out(args[1:],
+                             lambda symbol: self._history(date, symbol))
+
+    def today_respond(self, symbols):
+        "Respond to today's stock tracking of one or more symbols"
+        if len(symbols) == 0:
+            return None
+        return self._fan_out(symbols, self._today)
+
+    def _history(self, date, symbol):
+        "Respond to history stock of one symbol"
+        # Data of a past date never changes, no need to retrieve again
+        data = self._retrieve_stock(symbol, settled=date)
+        if self._function_key() not in data:
             return "Invalid stock symbol"
-        stocks = self.data[self._function_key()]
+        stocks = data[self._function_key()]
         if date not in stocks:
             return "Date too long ago or stock market was closed at: " + date
         history_stock = stocks[date]
@@ -398,7 +687,7 @@ class StockResponder(Responder):
         low = history_stock['3. low']
         close = history_stock['4. close']
         vol = history_stock['5. volume']
-        return "Stock symbol: " + self.symbol +"\n" +\
+        return "Stock symbol: " + symbol +"\n" +\
                 "Date: " + date + "\n" +\
                 "Open: " + open + "\n" +\
                 "High: " + high + "\n" +\
@@ -406,15 +695,12 @@ class StockResponder(Responder):
                 "Close: " + close + "\n" +\
                 "Volume: " + vol
 
-    def today_respond(self):
-        "Respond to today's stock tracking"
-        self.symbol = self.detail
-        if len(self.symbol.strip()) == 0:
-            return None
-        self._retrieve_stock()
-        if self._function_key() not in self.data:
+    def _today(self, symbol):
+        "Respond to today's stock tracking of one symbol"
+        data = self._retrieve_stock(symbol)
+        if self._function_key() not in data:
             return "Invalid stock symbol"
-        stocks = self.data[self._function_key()]
+        stocks = data[self._function_key()]
         if self._current_date() not in stocks:
             return "Stock market closed, no data given."
         today_stock = stocks[self._current_date()]
@@ -423,7 +709,7 @@ class StockResponder(Responder):
         low = today_stock['3. low']
         close = today_stock['4. close']
         vol = today_stock['5. volume']
-        return "Stock symbol: " + self.symbol +"\n" +\
+        return "Stock symbol: " + symbol +"\n" +\
                 "Date: " + self._current_date() + "\n" +\
                 "Open: " + open + "\n" +\
                 "High: " + high + "\n" +\
@@ -431,10 +717,158 @@ class StockResponder(Responder):
                 "Close: " + close + "\n" +\
                 "Volume: " + vol
 
-    def receive(self, puid, action, detail):
-        "Receive symbol that user is searching for"
-        self.detail = detail
-        self.action = action
+    def _range(self, start, end, symbol):
+        "Respond to the summary of one symbol from start to end"
+        bars = self._load_bars(symbol, settled=end)
+        if bars is None:
+            return "Invalid stock symbol"
+        bars = bars.between(start, end)
+        if len(bars) == 0:
+            return "No data from " + start + " to " + end
+        change = (bars.close[-1] - bars.open[0]) / bars.open[0] * 100
+        return "Stock symbol: " + symbol + "\n" +\
+                "From: " + str(bars.date[0]) + "\n" +\
+                "To: " + str(bars.date[-1]) + "\n" +\
+                "Trading days: " + str(len(bars)) + "\n" +\
+                "Open: " + self._price(bars.open[0]) + "\n" +\
+                "Close: " + self._price(bars.close[-1]) + "\n" +\
+                "High: " + self._price(bars.high.max()) + "\n" +\
+                "Low: " + self._price(bars.low.min()) + "\n" +\
+                "Average close: " + self._price(bars.close.mean()) + "\n" +\
+                "Volume: " + str(int(bars.volume.sum())) + "\n" +\
+                "Change: " + self._percent(change)
+
+    def _ma(self, days, symbol):
+        "Respond to the moving average of the close of one symbol"
+        bars = self._load_bars(symbol)
+        if bars is None:
+            return "Invalid stock symbol"
+        if len(bars) < days:
+            return "Not enough data, only " + str(len(bars)) + " days"
+        # The averages of the last two windows from the running sums
+        np = self.bars.np
+        window = bars.close[-(days + 1):]
+        sums = np.concatenate(([0.0], np.cumsum(window)))
+        averages = (sums[days:] - sums[:-days]) / days
+        close = bars.close[-1]
+        respond = "Stock symbol: " + symbol + "\n" +\
+                "Date: " + str(bars.date[-1]) + "\n" +\
+                str(days) + " day moving average: " +\
+                    self._price(averages[-1]) + "\n"
+        if len(averages) > 1:
+            respond += "Previous day: " + self._price(averages[-2]) + "\n"
+        return respond + "Close: " + self._price(close) + ", " +\
+                ("above" if close >= averages[-1] else "below") + " average"
+
+    def _change(self, days, symbol):
+        "Respond to the percent change of one symbol in the last days"
+        bars = self._load_bars(symbol)
+        if bars is None:
+            return "Invalid stock symbol"
+        if len(bars) < 2:
+            return "Not enough data, only " + str(len(bars)) + " days"
+        close = bars.close[-(days + 1):]
+        dates = bars.date[-(len(close) - 1):]
+        daily = (close[1:] - close[:-1]) / close[:-1] * 100
+        best = daily.argmax()
+        worst = daily.argmin()
+        return "Stock symbol: " + symbol + "\n" +\
+                "From: " + str(bars.date[-len(close)]) + "\n" +\
+                "To: " + str(bars.date[-1]) + "\n" +\
+                "Change: " + self._percent(
+                    (close[-1] - close[0]) / close[0] * 100) + "\n" +\
+                "Best day: " + str(dates[best]) + " " +\
+                    self._percent(daily[best]) + "\n" +\
+                "Worst day: " + str(dates[worst]) + " " +\
+                    self._percent(daily[worst])
+
+    def _analyze(self, symbols, respond):
+        "Call respond with each symbol if the bar store can be used"
+        if self.bars is None:
+            return "This request needs numpy, please ask the bot owner " +\
+                    "to install it"
+        return self._fan_out(symbols, respond)
+
+    def _days(self, args):
+        "Return the number of days in args, or the error message in str"
+        if len(args) < 2 or not args[0].isdigit():
+            return "Please give the number of days and the symbols"
+        days = int(args[0])
+        if days < 1 or days > self.max_days:
+            return "Number of days should be in [1, " +\
+                    str(self.max_days) + "]"
+        return days
+
+    def _load_bars(self, symbol, settled=None):
+        """
+        Return the Bars of the symbol with the days retrieved lately, None
+        if the symbol is invalid. See _retrieve_stock for settled
+        """
+        key = symbol.upper()
+        try:
+            stored = len(self.bars.load(key))
+        except ValueError:
+            return None
+        if stored == 0:
+            # Nothing stored yet, the cached series only has the last days
+            data = self.upstream.fetch(key + " full",
+                                       lambda: self._download(key, True))
+        else:
+            data = self._retrieve_stock(symbol, settled)
+        if self._function_key() not in data:
+            return None
+        self._store_bars(key, data[self._function_key()])
+        return self.bars.load(key)
+
+    def _store_bars(self, key, series):
+        "Add the new days in series to the bar store"
+        if self.bars is None:
+            return
+        try:
+            self.bars.update(key, series)
+        except (OSError, ValueError) as e:
+            self.logger.warning("Failed to store bars of %s: %r", key, e)
+
+    def _price(self, value):
+        return str(round(float(value), 4))
+
+    def _percent(self, value):
+        return ("+" if value >= 0 else "") + str(round(float(value), 2)) + "%"
+
+    def _fan_out(self, symbols, respond):
+        """
+        Call respond with each symbol concurrently and combine the responds
+        in one message. If one symbol failed, the others are still returned
+        """
+        # Remove repeated symbols but keep the order
+        symbols = list(OrderedDict((s.upper(), s) for s in symbols).values())
+        if len(symbols) > self.max_symbols:
+            return "Too many symbols, at most " + str(self.max_symbols) +\
+                    " symbols in one request"
+        if len(symbols) == 1:
+            try:
+                return respond(symbols[0])
+            except QuotaTimeout:
+                return "Too many requests, please try again later"
+            except Exception as e:
+                self.logger.error("Failed to retrieve %s: %r", symbols[0], e)
+                return "Failed to retrieve data"
+        respond = tracer.wrap(respond)
+        futures = [self.executor.submit(respond, s) for s in symbols]
+        responds = []
+        for symbol, future in zip(symbols, futures):
+            try:
+                result = future.result()
+            except QuotaTimeout:
+                result = "Too many requests, please try again later"
+            except Exception as e:
+                self.logger.error("Failed to retrieve %s: %r", symbol, e)
+                result = "Failed to retrieve data"
+            # Tell which symbol the error message belongs to
+            if not result.startswith("Stock symbol"):
+                result = "Stock symbol: " + symbol + "\n" + result
+            responds.append(result)
+        return "\n\n".join(responds)
 
     def _valid_date(self, date_text):
         "Check if date is in format yyyy-mm-dd"
@@ -452,62 +886,231 @@ class StockResponder(Responder):
         "Get current date in format yyyy-mm-dd"
         return datetime.datetime.now().strftime("%Y-%m-%d")
 
-    def _construct_full_url(self):
+    def _construct_full_url(self, symbol):
         "Construct full url"
-        return self.base_url + self.function + "&symbol=" + self.symbol + "&"+\
+        return self.base_url + self.function + "&symbol=" + symbol + "&"+\
                 self.api_key
 
-    def _retrieve_stock(self):
-        "Retrieve stock informations, store json data"
+    def _retrieve_stock(self, symbol, settled=None, priority=INTERACTIVE):
+        """
+        Retrieve stock informations, return json data. Use the cached data
+        if it has not expired yet. If settled date is given, expired data
+        is used as well as long as it was retrieved after that date.
+        Requests of the same symbol at the same time share one
+        """
+        key = symbol.upper()
+        accept = None
+        if settled is not None:
+            accept = lambda cached: settled < cached[1]
+        with tracer.span("cache", key="stock"):
+            cached = self.cache.get(key, accept=accept)
+            if cached is None:
+                cached = self._saved_stock(key, accept)
+        if cached is not None:
+            self.logger.log("Using cached stock informations of %s", key)
+            return cached[0]
+        return self.upstream.fetch(key, lambda: self._download(key),
+                                   priority)
+
+    def _download(self, key, full=False):
+        """
+        Send the request to alphavantage and cache the result. If full is
+        True, the full history is requested for the bar store, and only
+        the last days are cached
+        """
         self.logger.log("Retrieve stock informations from alphavantage")
-        full_url = self._construct_full_url()
-        with urllib.request.urlopen(full_url) as url:
-            self.data = json.loads(url.read().decode())
+        full_url = self._construct_full_url(key)
+        if full:
+            full_url += "&outputsize=full"
+        with metrics.timer("stock", "upstream"):
+            data = self.http.get_json(full_url)
+        # Do not cache errors, such as invalid symbol or too many requests
+        if self._function_key() in data:
+            self._store_bars(key, data[self._function_key()])
+            if full:
+                data = self._compact(data)
+            ttl = self._cache_ttl()
+            self.cache.put(key, (data, self._market_date()), ttl)
+            self.disk.put("stock:" + key, (data, self._market_date()), ttl)
+        return data
+
+    def _compact(self, data):
+        "Return a copy of data that only has the last compact_days days"
+        series = data[self._function_key()]
+        days = sorted(series, reverse=True)[:self.compact_days]
+        compact = dict(data)
+        compact[self._function_key()] = {day: series[day] for day in days}
+        return compact
+
+    def _saved_stock(self, key, accept):
+        "Return the series saved in disk, and cache it in memory, or None"
+        saved = self.disk.get_entry("stock:" + key)
+        if saved is None:
+            return None
+        cached, _, expires = saved
+        if expires <= time.time() and (accept is None or not accept(cached)):
+            return None
+        self.cache.put(key, cached, max(0, expires - time.time()))
+        return cached
+
+    def _market_timezone(self):
+        "Return the timezone of the stock market"
+        try:
+            from zoneinfo import ZoneInfo
+            return ZoneInfo("America/New_York")
+        except Exception:
+            # No timezone database, use eastern standard time
+            return datetime.timezone(datetime.timedelta(hours=-5))
+
+    def _market_date(self):
+        "Get current date of the stock market in format yyyy-mm-dd"
+        return datetime.datetime.now(self.market_tz).strftime("%Y-%m-%d")
+
+    def _cache_ttl(self):
+        """
+        Return seconds that newly retrieved data stays fresh. While the
+        market is open, prices keep changing and it only lasts open_ttl.
+        Otherwise the data will not change until the market opens again
+        """
+        now = datetime.datetime.now(self.market_tz)
+        opening = now.replace(hour=9, minute=30, second=0, microsecond=0)
+        # Alphavantage settles the daily data a while after 16:00
+        closing = now.replace(hour=17, minute=0, second=0, microsecond=0)
+        if now.weekday() < 5 and opening <= now < closing:
+            return self.open_ttl
+        if now >= opening:
+            opening += datetime.timedelta(days=1)
+        while opening.weekday() >= 5:
+            opening += datetime.timedelta(days=1)
+        return max(opening.timestamp() - now.timestamp(), self.open_ttl)
 
 
 class TranslationResponder(Responder):
     """
     TranslationResponder is respondible for translating the given sentence to
-    a different language.
+    a different language. Translations are remembered, so the same sentence
+    is only translated once. Sentences that arrive at almost the same time
+    are translated together in one call.
+    Set client_factory to another TranslateClient subclass, such as
+    FakeTranslateClient, to change the translation service. Set memory_path
+    to None to only remember translations in memory, and set batch_window
+    to 0 to translate every sentence in its own call
     """
+    keyword = "translate"
+    complex = True
+    alias_names = ("tr",)
+    cost = 2
+    client_factory = GoogleTranslateClient
+    # Valid language codes
+    action_names = ("af", "sq", "ar","be", "bg", "ca", "zh-CN", "zh-TW",
+             "hr", "cs", "da", "nl", "en", "et", "tl", "fi", "fr", "gl", "de",
+             "el", "iw", "hi", "hu", "is", "id", "ga", "it", "ja", "ko",
+             "lv", "lt", "mk", "ms", "mt", "no", "fa", "pl", "pt", "ro",
+             "ru", "sr", "sk", "sl", "es", "sw", "sv", "th", "tr", "uk",
+             "vi", "cy", "yi")
+    memory_path = "resources/translations.db"
+    batch_window = 0.005
+    # Seconds to wait for the translation of a batch
+    batch_timeout = 30
+
     def __init__(self):
         self.logger = Logger("TranslationResponder")
         self.logger.log("Initialized new TranslationResponder")
         self.codes = None
-        self.target_lang = None
-        self.detail = None
         self.client = None
+        self.lock = threading.Lock()
+        self.memory = TranslationMemory(path=self.memory_path)
+        metrics.gauge("translation memory", self.memory.stats)
+        self.batcher = None
+        if self.batch_window > 0:
+            self.batcher = MicroBatcher(self._translate_batch,
+                                        self.batch_window)
 
-    def key(self):
-        return "translate"
+    def handle(self, request):
+        if not len(request.detail.strip()) == 0:
+            return self._google_translate(request.detail, request.action)
 
-    def respond(self):
-        if not len(self.detail.strip()) == 0:
-            return self._google_translate()
+    def _google_translate(self, text, target_lang):
+        "Translate with remembered translations or the translate client"
+        with tracer.span("cache", key="translate"):
+            translated = self.memory.get(text, target_lang)
+        if translated is not None:
+            self.logger.log("Using remembered translation")
+            return translated
+        self.logger.log("Translating sentence using google translate api")
+        if self.batcher is not None:
+            try:
+                translated = self.batcher.submit(text, target_lang)\
+                        .result(self.batch_timeout)
+            except TimeoutError:
+                return "Translation timed out, please try again later"
+            except Exception as e:
+                # The batch failed, every text in it gets the same error
+                self.logger.error("Failed to translate: %r", e)
+                return "Failed to translate, please try again later"
+        else:
+            translated = self._translate_batch([text], target_lang)[0]
+        self.memory.put(text, target_lang, translated)
+        return translated
 
-    def is_complex(self):
-        return True
+    def _translate_batch(self, texts, target_lang):
+        "Translate a list of texts in one call of the client"
+        with self.lock:
+            if self.client is None:
+                self.client = self.client_factory()
+        with metrics.timer("translate", "upstream"):
+            return self.client.translate(texts, target_lang)
 
-    def actions(self):
-        "List of valid language codes"
-        return ["af", "sq", "ar","be", "bg", "ca", "zh-CN", "zh-TW", "hr",
-             "cs", "da", "nl", "en", "et", "tl", "fi", "fr", "gl", "de",
-             "el", "iw", "hi", "hu", "is", "id", "ga", "it", "ja", "ko",
-             "lv", "lt", "mk", "ms", "mt", "no", "fa", "pl", "pt", "ro",
-             "ru", "sr", "sk", "sl", "es", "sw", "sv", "th", "tr", "uk",
-             "vi", "cy", "yi"]
 
-    def receive(self, puid, action, detail):
-        self.target_lang = action
-        self.detail = detail
+class StatsResponder(Responder):
+    """
+    StatsResponder returns the number of requests, errors and latency of
+    each responder and stage, and the counters of caches. Only admins can
+    use it, other users will be ignored
+    """
+    keyword = "stats"
 
-    def _google_translate(self):
-        "Translate with google.cloud lib"
-        self.logger.log("Translating sentence using google translate api")
-        if self.client is None:
-            self.client = translate.Client()
-        trans = self.client.translate(
-            self.detail,
-            target_language = self.target_lang
-        )
-        return trans['translatedText']
+    def __init__(self):
+        self.logger = Logger("StatsResponder")
+        self.logger.log("Initialized new StatsResponder")
+
+    def handle(self, request):
+        if request.admin:
+            return metrics.summary()
+
+
+class ProfileResponder(Responder):
+    """
+    ProfileResponder turns the profiler on and off while the bot is
+    running. Only admins can use it, other users will be ignored
+        profile on [n]: profile one in n requests, 10 if not given
+        profile off: stop profiling and save the profiles
+        profile: show the slowest functions of each responder
+        profile reset: remove the profiles collected so far
+    """
+    keyword = "profile"
+    takes_detail = True
+
+    def __init__(self):
+        self.logger = Logger("ProfileResponder")
+        self.logger.log("Initialized new ProfileResponder")
+
+    def handle(self, request):
+        if not request.admin:
+            return None
+        args = request.args
+        if len(args) == 0:
+            return profiler.summary()
+        if args[0] == "on" and len(args) <= 2:
+            if len(args) == 2 and not args[1].isdigit():
+                return None
+            every = int(args[1]) if len(args) == 2 else 10
+            profiler.start(every)
+            return "Profiling one in " + str(profiler.every) + " requests"
+        if args == ["off"]:
+            profiler.stop()
+            return "Profiling stopped, profiles are saved to " + profiler.path
+        if args == ["reset"]:
+            profiler.reset()
+            return "Profiles removed"
+        return None
@@ -0,0 +1,81 @@
+from responds import Request
+
+class Router():
+    """
+    Router finds the responder of a request. All the keywords, actions and
+    their aliases and prefixes are put in dicts once when it is created, so
+    routing a message is a few dict lookups. Messages whose first word is
+    not a keyword are rejected before the rest of the message is split.
+    A keyword or action can be shortened to any prefix at least
+    min_prefix long, as long as no other keyword or action starts with it.
+    A simple request followed by a detail, such as 'weather toronto', must
+    use the whole keyword or an alias, and the responder must accept the
+    detail, so chatter such as 'weather is nice today' is not handled.
+    """
+    def __init__(self, responders, min_prefix=3):
+        """
+        Param: responders: All the responders
+        Param: min_prefix: The shortest prefix that can be used, 0 to turn
+            off prefix matching
+        """
+        self.min_prefix = min_prefix
+        self.keywords = {}      # keyword, alias or prefix:responder
+        self.actions = {}       # keyword:{action, alias or prefix:action}
+        names = {}
+        for r in responders:
+            names[r.key()] = r
+            for alias in r.aliases():
+                names[alias] = r
+            if r.is_complex():
+                actions = {a: a for a in r.actions() or []}
+                actions.update(r.action_aliases())
+                self.actions[r.key()] = self._with_prefixes(actions)
+        self.keywords = self._with_prefixes(names)
+        # Keywords and aliases, without the prefixes
+        self.names = frozenset(names)
+
+    def keyword_set(self):
+        "Return all the words that can start a request"
+        return frozenset(self.keywords)
+
+    def route(self, puid, text, admin=False):
+        """
+        Return (Responder, Request) of the text, None if it is not a valid
+        request. The formats are the same as wechatbot.get_responder
+        """
+        head, space, rest = text.partition(" ")
+        r = self.keywords.get(head)
+        if r is None:
+            return None
+        key = r.key()
+        if not r.is_complex():
+            if not space:
+                return r, Request(puid, key, admin=admin)
+            if head in self.names and r.accepts_detail(rest):
+                return r, Request(puid, key, detail=rest, admin=admin)
+            return None
+        action, space, detail = rest.partition(" ")
+        if not space:
+            return None
+        action = self.actions[key].get(action)
+        if action is None:
+            return None
+        return r, Request(puid, key, action, detail, admin)
+
+    def _with_prefixes(self, names):
+        """
+        Return a copy of names, a dict in name:value format, that also has
+        the prefixes that only one value can be found by
+        """
+        table = dict(names)
+        if self.min_prefix <= 0:
+            return table
+        prefixes = {}
+        for name, value in names.items():
+            for end in range(self.min_prefix, len(name)):
+                prefixes.setdefault(name[:end], set()).add(value)
+                table.setdefault(name[:end], value)
+        for prefix, values in prefixes.items():
+            if prefix not in names and len(values) > 1:
+                del table[prefix]
+        return table
@@ -0,0 +1,333 @@
+import argparse
+import itertools
+import json
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from logger import *
+
+class Trace():
+    """
+    The spans of one message, from the time it is received until the reply
+    is sent. A trace is passed along with the request, and to the threads
+    that do part of its work
+    Var: id: The trace id, 16 hex digits
+    Var: attrs: Values written with the root span, such as the request key
+    """
+    def __init__(self, name, attrs):
+        """
+        Param: name: The name of the root span
+        Param: attrs: Dict of values written with the root span
+        """
+        self.id = "%016x" % random.getrandbits(64)
+        self.name = name
+        self.attrs = attrs
+        self.started = time.time()
+        self.perf = time.perf_counter()
+        # Span ids, 0 is the root span
+        self.ids = itertools.count(1)
+        self.finished = False
+
+
+class Tracer():
+    """
+    Tracer follows single requests end to end. Every message gets a Trace
+    with an id, and the stages it goes through, such as parsing, cache
+    lookups, upstream calls and sending the reply, are recorded as timed
+    spans. The spans are written to a json lines file by a background
+    thread, recording one only puts it in a queue, and spans are dropped
+    when the queue is full rather than slowing the requests down. The file
+    is rotated when it gets larger than max_bytes, the old files are kept
+    as '<path>.1' to '<path>.<backups>'. Nothing is recorded until it is
+    started. Run this file to summarize the traces:
+        $ python tracer.py resources/traces.jsonl
+    """
+    def __init__(self, path="resources/traces.jsonl",
+                 max_bytes=16 * 1024 * 1024, backups=3, max_queue=10000,
+                 batch_size=256):
+        """
+        Param: path: The file to write the spans to
+        Param: max_bytes: Max size of the file before it is rotated
+        Param: backups: Number of rotated files to keep
+        Param: max_queue: Max spans waiting to be written
+        Param: batch_size: Max number of spans written at once
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch_size = batch_size
+        self.enabled = False
+        self.queue = queue.Queue(max_queue)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.traces = 0
+        self.written = 0
+        self.dropped = 0
+        self.logger = Logger("Tracer")
+
+    def start(self, path=None):
+        "Start tracing, write the spans to path if it is given"
+        with self.lock:
+            if path is not None:
+                self.path = path
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True,
+                                               name="TraceWriter")
+                self.thread.start()
+            self.enabled = True
+        self.logger.log("Tracing to %s", self.path)
+
+    def stop(self):
+        "Stop tracing, the spans already recorded are still written"
+        self.enabled = False
+
+    def begin(self, name, **attrs):
+        "Return a new Trace with a root span of name, None if not tracing"
+        if not self.enabled:
+            return None
+        with self.lock:
+            self.traces += 1
+        return Trace(name, attrs)
+
+    def finish(self, trace, **attrs):
+        "Record the root span of the trace, it ends now"
+        if trace is None or trace.finished:
+            return
+        trace.finished = True
+        trace.attrs.update(attrs)
+        self._record(trace, 0, None, trace.name, trace.perf,
+                     time.perf_counter(), trace.attrs)
+
+    @contextmanager
+    def use(self, trace, parent=0):
+        """
+        Make trace the trace of the spans recorded in the with block by
+        this thread, they are under the span with id parent
+        """
+        previous = (getattr(self.local, "trace", None),
+                    getattr(self.local, "stack", None))
+        self.local.trace = trace
+        # Ids of the spans that are open, the last one is the parent
+        self.local.stack = [parent]
+        try:
+            yield trace
+        finally:
+            self.local.trace, self.local.stack = previous
+
+    def wrap(self, fn):
+        """
+        Return a function that calls fn under the current trace and span,
+        for fn to be run by another thread, fn itself if there is no trace
+        """
+        trace = getattr(self.local, "trace", None)
+        if trace is None:
+            return fn
+        parent = self.local.stack[-1]
+        def traced(*args, **kwargs):
+            with self.use(trace, parent):
+                return fn(*args, **kwargs)
+        return traced
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """
+        Record the with block as a span of the current trace, nothing is
+        done if there is no trace. The span fails if an exception is raised:
+            with tracer.span("cache", key=city):
+                ...
+        """
+        trace = getattr(self.local, "trace", None)
+        if trace is None:
+            yield
+            return
+        id = next(trace.ids)
+        stack = self.local.stack
+        parent = stack[-1]
+        stack.append(id)
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            attrs["error"] = True
+            raise
+        finally:
+            stack.pop()
+            self._record(trace, id, parent, name, start, time.perf_counter(),
+                         attrs)
+
+    def add(self, name, start, **attrs):
+        """
+        Record a span of the current trace that started at start, a
+        perf_counter() value, and ends now, such as time spent in a queue
+        """
+        trace = getattr(self.local, "trace", None)
+        if trace is None:
+            return
+        self._record(trace, next(trace.ids), self.local.stack[-1], name,
+                     start, time.perf_counter(), attrs)
+
+    def flush(self):
+        "Wait until all the recorded spans are written"
+        if self.thread is not None:
+            self.queue.join()
+
+    def stats(self):
+        "Return the counters in dict"
+        with self.lock:
+            return {
+                "traces": self.traces,
+                "written": self.written,
+                "dropped": self.dropped,
+                "queued": self.queue.qsize(),
+            }
+
+    def _record(self, trace, id, parent, name, start, end, attrs):
+        "Put the span in the queue, drop it if the queue is full"
+        span = {
+            "trace": trace.id,
+            "span": id,
+            "parent": parent,
+            "name": name,
+            "start": round(trace.started + start - trace.perf, 6),
+            "ms": round((end - start) * 1000, 3),
+        }
+        span.update(attrs)
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def _loop(self):
+        "Write the spans in batches"
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write("".join(json.dumps(span, ensure_ascii=False) +
+                                    "\n" for span in batch))
+                with self.lock:
+                    self.written += len(batch)
+            except Exception as e:
+                self.logger.error("Failed to write spans: %r", e)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write(self, data):
+        "Append data to the file, rotate it first if it is too large"
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+        if size > 0 and size + len(data) > self.max_bytes:
+            self._rotate()
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+
+    def _rotate(self):
+        "Rename the file to '<path>.1', the older files move up by one"
+        for i in range(self.backups, 0, -1):
+            source = self.path if i == 1 else self.path + "." + str(i - 1)
+            if os.path.exists(source):
+                os.replace(source, self.path + "." + str(i))
+        if self.backups <= 0:
+            os.remove(self.path)
+
+
+def load_traces(paths):
+    "Read the spans in the files, return a dict of trace id:list of spans"
+    traces = {}
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    # The last line of a file may be cut off by a crash
+                    continue
+                traces.setdefault(span["trace"], []).append(span)
+    return traces
+
+def summarize(traces, top=10):
+    """
+    Return the lines of a summary of the traces, the slowest traces with
+    their spans, and the stages where the most time is spent
+    """
+    roots = []
+    stages = {}     # (request key, span name):list of ms
+    for spans in traces.values():
+        root = next((s for s in spans if s["parent"] is None), None)
+        if root is None:
+            # The message is still being handled, or it was dropped
+            continue
+        roots.append((root, spans))
+        key = root.get("key", "-")
+        for span in spans:
+            if span["parent"] is not None:
+                stages.setdefault((key, span["name"]), []).append(span["ms"])
+    roots.sort(key=lambda item: item[0]["ms"], reverse=True)
+    total = sum(root["ms"] for root, _ in roots) or 1
+    lines = [str(len(roots)) + " traces, " + str(round(total / 1000, 1)) +
+             "s in total", "", "Slowest traces:"]
+    for root, spans in roots[:top]:
+        lines.append("  " + root["trace"] + " " + str(root["ms"]) + "ms " +
+                     time.strftime("%Y-%m-%d %H:%M:%S",
+                                   time.localtime(root["start"])) + " " +
+                     " ".join(k + "=" + str(v) for k, v in root.items()
+                              if k not in ("trace", "span", "parent", "name",
+                                           "start", "ms")))
+        lines.extend(_span_tree(spans, 0, "    "))
+    lines.append("")
+    lines.append("Stages by total time:")
+    ranked = sorted(stages.items(), key=lambda item: sum(item[1]),
+                    reverse=True)
+    for (key, name), values in ranked[:top]:
+        values.sort()
+        lines.append("  " + key + "/" + name + ": " +
+                     str(round(sum(values) * 100 / total, 1)) + "%, " +
+                     str(len(values)) + " spans, p50 " +
+                     str(values[len(values) // 2]) + "ms, p95 " +
+                     str(values[int(len(values) * 0.95)]) + "ms, max " +
+                     str(values[-1]) + "ms")
+    return lines
+
+def _span_tree(spans, parent, indent):
+    "Return the lines of the spans under parent, in the order they started"
+    lines = []
+    for span in sorted((s for s in spans if s["parent"] == parent),
+                       key=lambda s: s["start"]):
+        lines.append(indent + span["name"] + " " + str(span["ms"]) + "ms" +
+                     (" error" if span.get("error") else ""))
+        lines.extend(_span_tree(spans, span["span"], indent + "  "))
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the traces "
+                                     "written by wechatbot")
+    parser.add_argument("path", nargs="?", default="resources/traces.jsonl",
+                        help="the trace file, its rotated files are read too")
+    parser.add_argument("--top", type=int, default=10,
+                        help="number of traces and stages to show")
+    args = parser.parse_args()
+    paths = [args.path + "." + str(i) for i in range(99, 0, -1)] + [args.path]
+    traces = load_traces([p for p in paths if os.path.exists(p)])
+    print("\n".join(summarize(traces, args.top)))
+
+
+# The tracer shared by wechatbot and all responders, off until it is started
+tracer = Tracer()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import sqlite3
+import threading
+import unicodedata
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from cache import *
+from logger import *
+
+class TranslateClient(ABC):
+    """
+    The parent class of translation clients. TranslationResponder only
+    talks to the translation service through this interface, so it can be
+    replaced by FakeTranslateClient to work offline.
+    """
+    @abstractmethod
+    def translate(self, texts, target_lang):
+        "Translate a list of texts, return the translations in the same order"
+
+
+class GoogleTranslateClient(TranslateClient):
+    "TranslateClient that uses google.cloud.translate"
+    def __init__(self):
+        # Import here so the heavy SDK is only loaded when translating
+        from google.cloud import translate
+        self.client = translate.Client()
+
+    def translate(self, texts, target_lang):
+        results = self.client.translate(texts, target_language=target_lang)
+        return [r['translatedText'] for r in results]
+
+
+class FakeTranslateClient(TranslateClient):
+    """
+    TranslateClient that does not translate anything, it returns texts in
+    format '[target_lang] text'. Every call is kept in calls, in
+    (texts, target_lang) format
+    """
+    def __init__(self):
+        self.calls = []
+
+    def translate(self, texts, target_lang):
+        self.calls.append((list(texts), target_lang))
+        return ["[" + target_lang + "] " + text for text in texts]
+
+
+class TranslationMemory():
+    """
+    Remember translations by normalized text and target language. Recent
+    translations are kept in memory, and if path is given, all translations
+    are also saved in a SQLite database so they survive restarts.
+    """
+    def __init__(self, maxsize=1024, path=None):
+        """
+        Param: maxsize: Max number of translations kept in memory
+        Param: path: The SQLite database file, None to only use memory
+        """
+        self.cache = LRUCache(maxsize=maxsize, ttl=float("inf"))
+        self.conn = None
+        self.lock = threading.Lock()
+        if path is not None:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            with self.lock, self.conn:
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS translations ("
+                    "text TEXT NOT NULL, "
+                    "target TEXT NOT NULL, "
+                    "translated TEXT NOT NULL, "
+                    "PRIMARY KEY (text, target))")
+
+    def normalize(self, text):
+        "Return text in the form used as key"
+        return " ".join(unicodedata.normalize("NFC", text).split())
+
+    def get(self, text, target_lang):
+        "Return the remembered translation, None if there is none"
+        key = (self.normalize(text), target_lang)
+        translated = self.cache.get(key)
+        if translated is not None or self.conn is None:
+            return translated
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT translated FROM translations "
+                "WHERE text = ? AND target = ?", key).fetchone()
+        if row is None:
+            return None
+        self.cache.put(key, row[0])
+        return row[0]
+
+    def put(self, text, target_lang, translated):
+        "Remember the translation"
+        key = (self.normalize(text), target_lang)
+        self.cache.put(key, translated)
+        if self.conn is not None:
+            with self.lock, self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO translations "
+                    "(text, target, translated) VALUES (?, ?, ?)",
+                    key + (translated,))
+
+    def stats(self):
+        "Return the counters of the memory tier"
+        return self.cache.stats()
+
+
+class MicroBatcher():
+    """
+    Collect the texts that arrive within window seconds and translate them
+    with one call for each target language. A batch is also sent right
+    away once it has max_batch texts.
+    """
+    def __init__(self, translate, window=0.005, max_batch=64):
+        """
+        Param: translate: Function that takes (texts, target_lang) and
+            returns the translations in the same order
+        Param: window: Seconds to wait for more texts after the first one
+        Param: max_batch: Max number of texts in one call
+        """
+        self.translate = translate
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.pending = {}       # target_lang:[(text, Future)]
+        self.batches = 0
+        self.logger = Logger("MicroBatcher")
+
+    def submit(self, text, target_lang):
+        "Add text to the batch, return Future of its translation"
+        future = Future()
+        full = None
+        with self.lock:
+            batch = self.pending.setdefault(target_lang, [])
+            batch.append((text, future))
+            if len(batch) >= self.max_batch:
+                full = self.pending.pop(target_lang)
+            elif len(batch) == 1:
+                timer = threading.Timer(self.window, self._flush,
+                                        args=(target_lang, batch))
+                timer.daemon = True
+                timer.start()
+        if full is not None:
+            self._send(target_lang, full)
+        return future
+
+    def _flush(self, target_lang, batch):
+        "Send the batch when window is over, unless it was sent already"
+        with self.lock:
+            if self.pending.get(target_lang) is not batch:
+                return
+            del self.pending[target_lang]
+        self._send(target_lang, batch)
+
+    def _send(self, target_lang, batch):
+        "Translate the texts in one call and resolve their futures"
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        self.batches += 1
+        self.logger.log("Translating batch of %d texts to %s", len(texts),
+                        target_lang)
+        try:
+            results = dict(zip(texts, self.translate(texts, target_lang)))
+            for text, future in batch:
+                if text in results:
+                    future.set_result(results[text])
+                else:
+                    future.set_exception(LookupError(
+                        "No translation of the text in the batch"))
+        except Exception as e:
+            self.logger.error("Failed to translate batch: %r", e)
+            # Never leave a request waiting for a future nobody resolves
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
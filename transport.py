@@ -0,0 +1,247 @@
+import itertools
+import threading
+import time
+from abc import ABC, abstractmethod
+from logger import *
+from metrics import Histogram
+
+class Transport(ABC):
+    """
+    Transport connects wechatbot to a chat service. wechatbot only uses the
+    methods below, so the same routing, responders and send path run on
+    Wechat, or on a simulated service for testing and load tests.
+    A chat is a user or yourself, it has name, puid and send(message).
+    A message has sender, a chat, text and reply(message). A message from
+    a group chat also has member, the member who sent it, and is_at, True
+    if it mentions yourself.
+    """
+    @abstractmethod
+    def me(self):
+        "Return the chat of yourself"
+        pass
+
+    @abstractmethod
+    def friends(self, update=False):
+        "Return the chats of all friends, update them from the service first"
+        pass
+
+    @abstractmethod
+    def listen(self, handler, allow_self=True):
+        """
+        Start receiving text messages, call handler(message) with each of
+        them. Messages sent by yourself are ignored unless allow_self
+        """
+        pass
+
+    def wait(self):
+        "Block until the transport is stopped"
+        pass
+
+    def stop(self):
+        "Stop receiving messages"
+        pass
+
+
+class WxpyTransport(Transport):
+    """
+    Transport of Wechat, with a wxpy Bot. wxpy is imported when the bot is
+    created, so the rest of wechatbot runs without it
+    """
+    def __init__(self, bot=None, cache_path=True, auto_mark=False):
+        """
+        Param: bot: The wxpy Bot, or an object that works like one, a new
+            Bot logs in if None
+        Param: cache_path: Cache the login of the new Bot, avoid scanning QR
+            too many times
+        Param: auto_mark: Automatically mark messages as read
+        """
+        if bot is None:
+            from wxpy import Bot
+            bot = Bot(cache_path=cache_path)
+        self.bot = bot
+        self.bot.enable_puid()
+        self.bot.auto_mark_as_read = auto_mark
+
+    def me(self):
+        return self.bot.self
+
+    def friends(self, update=False):
+        return self.bot.friends(update=update)
+
+    def listen(self, handler, allow_self=True):
+        from wxpy import TEXT
+        self.bot.register(msg_types=TEXT, except_self=not allow_self)(handler)
+
+    def wait(self):
+        "Keep the thread alive in a python console until the user exits"
+        from wxpy import embed
+        embed()
+
+    def stop(self):
+        self.bot.logout()
+
+
+class SimulatedChat():
+    "A simulated user or yourself, messages sent to it are counted"
+    def __init__(self, transport, name, puid):
+        """
+        Param: transport: The SimulatedTransport the chat belongs to
+        Param: name: The name of the user
+        Param: puid: The unique id of the user
+        """
+        self.transport = transport
+        self.name = name
+        self.puid = puid
+
+    def send(self, msg):
+        self.transport._delivered(self, None, msg)
+
+    def __repr__(self):
+        return "<SimulatedChat: " + self.name + ">"
+
+
+class SimulatedMessage():
+    """
+    A text message from a simulated user
+    Var: received: perf_counter() when the bot received it
+    Var: replied: perf_counter() of the first reply, None if no reply yet
+    Var: replies: The replies, if the transport keeps them
+    """
+    type = "Text"
+
+    def __init__(self, transport, sender, text):
+        """
+        Param: transport: The SimulatedTransport the message belongs to
+        Param: sender: The SimulatedChat who sent it
+        Param: text: The text of the message
+        """
+        self.transport = transport
+        self.sender = sender
+        self.text = text
+        self.received = None
+        self.replied = None
+        self.replies = []
+
+    def reply(self, msg):
+        self.transport._delivered(self.sender, self, msg)
+
+
+class SimulatedTransport(Transport):
+    """
+    Transport of simulated users in the same process, no chat service is
+    needed. Messages are injected with receive() one at a time, or with
+    inject() at a given rate from many users, and go through wechatbot the
+    same as messages from Wechat. The time from receiving a message to its
+    first reply is recorded, and replies are only kept if keep is True, so
+    millions of messages can be injected.
+    """
+    def __init__(self, users=100, keep=False, on_reply=None):
+        """
+        Param: users: Number of simulated users, or a list of their names
+        Param: keep: Keep the replies of every message in message.replies
+        Param: on_reply: Function that takes (message, reply), called with
+            every reply, message is None if it is sent to a chat
+        """
+        if isinstance(users, int):
+            users = ["user" + str(i) for i in range(users)]
+        self.users = [SimulatedChat(self, name, "puid" + str(i))
+                      for i, name in enumerate(users)]
+        self.self_chat = SimulatedChat(self, "self", "self")
+        self.keep = keep
+        self.on_reply = on_reply
+        self.handler = None
+        self.allow_self = True
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.latency = Histogram()
+        self.received = 0
+        self.replied = 0
+        self.replies = 0
+        self.sent = 0
+        self.logger = Logger("SimulatedTransport")
+
+    def me(self):
+        return self.self_chat
+
+    def friends(self, update=False):
+        return list(self.users)
+
+    def listen(self, handler, allow_self=True):
+        self.handler = handler
+        self.allow_self = allow_self
+
+    def wait(self):
+        self.stopped.wait()
+
+    def stop(self):
+        self.stopped.set()
+
+    def message(self, sender, text):
+        "Return a new message of text from sender, a chat or a user name"
+        if isinstance(sender, str):
+            sender = next(u for u in self.users + [self.self_chat]
+                          if u.name == sender)
+        return SimulatedMessage(self, sender, text)
+
+    def receive(self, msg):
+        "Let the bot receive the message, return after the handler returns"
+        msg.received = time.perf_counter()
+        with self.lock:
+            self.received += 1
+        if self.handler is None:
+            return
+        if msg.sender is self.self_chat and not self.allow_self:
+            return
+        self.handler(msg)
+
+    def inject(self, texts, count, rate=None):
+        """
+        Receive count messages, the texts in turn, each from the next user,
+        at rate messages per second, or as fast as possible if None.
+        Return the messages, and the rate they were received at, in tuple
+        """
+        texts = itertools.cycle(texts)
+        users = itertools.cycle(self.users)
+        messages = [SimulatedMessage(self, next(users), next(texts))
+                    for _ in range(count)]
+        start = time.perf_counter()
+        for i, msg in enumerate(messages):
+            if rate is not None:
+                delay = start + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            self.receive(msg)
+        elapsed = time.perf_counter() - start
+        self.logger.log("Injected %d messages in %.2fs", count, elapsed)
+        return messages, count / elapsed if elapsed > 0 else 0.0
+
+    def stats(self):
+        "Return the counters and reply latency in dict"
+        with self.lock:
+            return {
+                "received": self.received,
+                "replied": self.replied,
+                "replies": self.replies,
+                "sent": self.sent,
+                "p50": self.latency.percentile(50),
+                "p95": self.latency.percentile(95),
+                "p99": self.latency.percentile(99),
+                "max": self.latency.max,
+            }
+
+    def _delivered(self, chat, msg, reply):
+        "Record a reply to msg, or a message sent to chat if msg is None"
+        now = time.perf_counter()
+        with self.lock:
+            if msg is None:
+                self.sent += 1
+            else:
+                self.replies += 1
+                if msg.replied is None:
+                    msg.replied = now
+                    self.replied += 1
+                    self.latency.add(now - msg.received)
+                if self.keep:
+                    msg.replies.append(reply)
+        if self.on_reply is not None:
+            self.on_reply(msg, reply)
@@ -0,0 +1,205 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from logger import *
+from metrics import *
+from ratelimit import *
+from tracer import tracer
+
+# Priorities of calls to a provider, lower goes first
+INTERACTIVE = 0     # A user is waiting for the result
+BACKGROUND = 1      # Refreshes and polls that nobody is waiting for
+
+class QuotaTimeout(Exception):
+    "Raised when a call waited too long for the quota of the provider"
+
+
+class Ticket():
+    "A call waiting for its turn in QuotaScheduler"
+    def __init__(self, priority):
+        self.priority = priority
+        self.granted = threading.Event()
+        self.cancelled = False
+
+
+class QuotaScheduler():
+    """
+    QuotaScheduler keeps the calls to one provider within its quota, such
+    as 5 calls per minute. Calls over the quota wait in a queue instead of
+    failing, and whenever the quota allows one more call, the waiting call
+    with the highest priority goes first, so users are not kept waiting by
+    background refreshes.
+    """
+    def __init__(self, name, rate, burst=1):
+        """
+        Param: name: The name of the provider
+        Param: rate: Calls allowed per second, such as 5 / 60
+        Param: burst: Calls allowed at once
+        """
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.cond = threading.Condition()
+        self.queue = []     # heap of (priority, seq, Ticket)
+        self.seq = itertools.count()
+        self.thread = None
+        self.queued = 0
+
+    def submit(self, priority=INTERACTIVE):
+        """
+        Return a Ticket for one call, it is granted right away if the quota
+        allows and nothing is waiting, otherwise it is queued
+        """
+        ticket = Ticket(priority)
+        with self.cond:
+            if not self.queue and self.bucket.try_acquire():
+                ticket.granted.set()
+                return ticket
+            self.queued += 1
+            heapq.heappush(self.queue, (priority, next(self.seq), ticket))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._grant_loop,
+                                               daemon=True,
+                                               name="Quota-" + self.name)
+                self.thread.start()
+            self.cond.notify()
+        return ticket
+
+    def wait(self, ticket, timeout=None):
+        """
+        Wait until the ticket is granted, raise QuotaTimeout if timeout
+        seconds passed first. Return the seconds waited
+        """
+        start = time.perf_counter()
+        if not ticket.granted.wait(timeout):
+            with self.cond:
+                if not ticket.granted.is_set():
+                    ticket.cancelled = True
+                    raise QuotaTimeout("No quota of " + self.name + " in " +
+                                       str(timeout) + " seconds")
+        return time.perf_counter() - start
+
+    def acquire(self, priority=INTERACTIVE, timeout=None):
+        "Wait for the turn of one call, see wait()"
+        return self.wait(self.submit(priority), timeout)
+
+    def promote(self, ticket, priority):
+        "Let a waiting ticket go with a higher priority"
+        with self.cond:
+            if ticket.granted.is_set() or priority >= ticket.priority:
+                return
+            # The old entry is skipped when it reaches the top
+            ticket.priority = priority
+            heapq.heappush(self.queue, (priority, next(self.seq), ticket))
+            self.cond.notify()
+
+    def waiting(self):
+        "Return the number of calls waiting"
+        with self.cond:
+            return sum(1 for entry in self.queue if self._live(entry))
+
+    def _grant_loop(self):
+        "Grant the waiting tickets one by one as the quota allows"
+        while True:
+            with self.cond:
+                while self._head() is None:
+                    self.cond.wait()
+            self.bucket.acquire()
+            with self.cond:
+                # A ticket with higher priority may have come meanwhile
+                ticket = self._head()
+                if ticket is None:
+                    self.bucket.refund()
+                    continue
+                heapq.heappop(self.queue)
+                ticket.granted.set()
+
+    def _head(self):
+        "Return the next ticket to grant, must hold the lock"
+        while self.queue and not self._live(self.queue[0]):
+            heapq.heappop(self.queue)
+        return self.queue[0][2] if self.queue else None
+
+    def _live(self, entry):
+        "Return True if the queue entry is still waiting"
+        priority, _, ticket = entry
+        return not ticket.granted.is_set() and not ticket.cancelled and \
+            priority == ticket.priority
+
+
+class Upstream():
+    """
+    Upstream is the way responders call an external API. Calls with the
+    same key that run at the same time share one call, so many users asking
+    for the same city or symbol only cost one request, and all calls go
+    through a QuotaScheduler that keeps them within the quota of the API.
+    """
+    def __init__(self, name, rate, burst=1, timeout=60):
+        """
+        Param: name: The name of the API
+        Param: rate: Calls allowed per second
+        Param: burst: Calls allowed at once
+        Param: timeout: Seconds an interactive call waits for the quota
+            before QuotaTimeout is raised, background calls wait forever
+        """
+        self.name = name
+        self.scheduler = QuotaScheduler(name, rate, burst)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.flights = {}   # key:(Future, Ticket)
+        self.calls = 0
+        self.coalesced = 0
+        self.logger = Logger("Upstream")
+
+    def fetch(self, key, fn, priority=INTERACTIVE):
+        """
+        Return fn(), or the result of the same call with the same key that
+        is already running. Raise what fn raises, or QuotaTimeout
+        """
+        timeout = self.timeout if priority == INTERACTIVE else None
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                future = Future()
+                ticket = self.scheduler.submit(priority)
+                self.flights[key] = (future, ticket)
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if flight is not None:
+            future, ticket = flight
+            self.scheduler.promote(ticket, priority)
+            try:
+                with tracer.span("coalesced", upstream=self.name):
+                    return future.result(timeout)
+            except TimeoutError:
+                raise QuotaTimeout("No result from " + self.name + " in " +
+                                   str(timeout) + " seconds")
+        try:
+            with tracer.span("quota wait", upstream=self.name):
+                waited = self.scheduler.wait(ticket, timeout)
+            if waited > 0.001:
+                self.logger.debug("Waited %.2fs for quota of %s", waited,
+                                  self.name)
+                metrics.observe(self.name, "quota wait", waited)
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.flights[key]
+
+    def stats(self):
+        "Return the counters in dict"
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+                "waiting": self.scheduler.waiting(),
+                "queued": self.scheduler.queued,
+            }
@@ -1,6 +1,19 @@
+import time
+start_time = time.perf_counter()
+import threading
 from responds import *
-from wxpy import *
 from logger import *
+from metrics import *
+from router import *
+from registry import *
+from friends import *
+from broadcast import *
+from admission import *
+from chunks import *
+from prefilter import *
+from tracer import tracer
+from transport import *
+from concurrent.futures import ThreadPoolExecutor
 
 #
 #   Boolean that controls some features
@@ -12,37 +25,103 @@ send_bye = False     # send bye message to users when offline
 restrict = True     # Restriction, only users on list can access the bot
 allow_self = True   # allow access bot by yourself
 auto_mark = False   # Automatically mark messages as read
+workers = 8         # Number of requests that can be handled at the same time
+log_level = INFO    # Lowest level of logs to show, DEBUG/INFO/WARNING/ERROR
+log_json = None     # Path of the file to write logs as json lines, None to
+                    # show logs on console
+stats_dump = None   # Path of the file to dump request stats to, None to
+                    # not dump them
+stats_interval = 60 # Seconds between two dumps of request stats
+friend_refresh = 300 # Seconds between two refreshes of friend list and
+                     # whitelist, 0 to never refresh
+broadcast_rate = 1.0 # Max messages per second when sending to many users
+broadcast_concurrency = 2 # Number of threads sending to many users
+user_rate = 0.5     # Requests a user can send per second, on average
+user_burst = 5      # Requests a user can send at once
+global_rate = 10    # Requests all users can send per second, on average
+global_burst = 30   # Requests all users can send at once
+max_pending = 100   # Max requests waiting or being handled, new requests
+                    # are answered with busy_message when it is full
+max_reply = 2000    # Max characters in one message, longer replies are
+                    # sent in several messages
+max_reply_messages = 5 # Max messages of one reply, the rest is cut off
+cache_preload = 64  # Number of the most used upstream responses read from
+                    # disk into memory at start
+alert_interval = 300 # Seconds between two checks of the stock watches, 0 to
+                     # never check
+trigger = None      # Prefix every request must start with, such as "@bot",
+                    # None to accept messages starting with a keyword
+group_chats = False # Respond in group chats to requests that mention the
+                    # bot or start with trigger
+trace_file = None   # Path of the file to write the spans of every request
+                    # to as json lines, None to not trace requests
 
 # 39L1WOFKTYSACMQO
 
 #
 #   Variables
 #
+# How long each phase of start took
+startup = StartupTimer(start_time)
+startup.mark("imports")
+set_level(log_level)
+if log_json is not None:
+    use_json_lines(log_json)
 logger = Logger("WechatBot", do_log)
 logger.log("Initializing WechatBot")
-responder_list = [cls() for cls in Responder.__subclasses__()]
+# Responders are created when their first request arrives
+responder_list = load_responders(Responder.__subclasses__())
 responder_map = {} # A map that stores in format 'responder_keyword':responder
 # Provide user names for restriction
 username_list = [
                 ]
-# Only users in this list can access bot, if restrict is True
+# File of more user names for restriction, one name per line, it can be
+# edited while the bot is running
+username_file = "resources/whitelist.txt"
+# Only users in this Whitelist can access bot, if restrict is True
 users = None
+# Find friends by name or puid
+friend_index = FriendIndex()
+# The puid of admins
+admins = set()
+# The Transport of the chat service, set when the bot is activated
+transport = None
+# Provide user names of admins, who can use admin requests such as stats.
+# Yourself is always an admin
+admin_list = [
+             ]
 # Greeting message
 greeting = "WechatBot v0.1b is online now, send help for more informations"
 # Bye message
 bye = "WechatBot v0.1b is offline now, thank you for using :)"
+# Message to users who send requests too fast
+limited_message = "Too many requests, please wait a moment"
+# Message to users when the bot has too many requests
+busy_message = "WechatBot is busy now, please try again later"
+# Message sent after max_reply_messages when a reply is cut off
+cut_message = "The reply is too long, the rest is not shown. Send " +\
+        "'note show page {page}' to see notes ten at a time, or ask for " +\
+        "less at once"
 # Fill dict
 for r in responder_list:
     responder_map[r.key()] = r
-
-
-#
-#   Scripts
-#
-logger.log("Activating WechatBot")
-bot = Bot(cache_path=True)  # Allow cache, avoid scanning QR too many times
-bot.enable_puid()
-bot.auto_mark_as_read = auto_mark
+startup.mark("load responders")
+# Find responders by keywords, built once from all responders
+router = Router(responder_list)
+startup.mark("build router")
+# Rate limits and max pending requests
+admission = AdmissionControl(user_rate, user_burst, global_rate,
+                             global_burst, max_pending)
+metrics.gauge("admission", admission.stats)
+# Drops messages that are not requests before they are logged
+prefilter = MessageFilter(router.keyword_set(), trigger, group_chats)
+metrics.gauge("prefilter", prefilter.stats)
+metrics.gauge("response cache", response_cache.stats)
+metrics.gauge("stock alerts", stock_alerts.stats)
+metrics.gauge("tracer", tracer.stats)
+# Threads that run responders, slow responders will not block others
+executor = ThreadPoolExecutor(max_workers=workers,
+                              thread_name_prefix="Responder")
 
 
 #
@@ -52,99 +131,257 @@ def get_responder(sender, request):
     """
     Get responder corresponding to the given keyword in request
     There are two kinds of format:
-        simple: weather, help...
+        simple: weather, help, weather toronto...
             return 'weather', 'help'...
         complex: note add blablabla, note del blablabla
             return ['note','add','blablabla']...
+    Keywords and actions can also be their aliases or unique prefixes,
+    such as 'tr' for 'translate', see router.Router
     Return None if input str is not a valid key
-    Return Responder if keyword is matched
+    Return (Responder, Request) if keyword is matched
     """
-    splitter = request.split(" ")
-    main_key = splitter[0]
-    # Make sure main key is in key list
-    if main_key in responder_map:
-        r = responder_map[main_key]
-        # Handle simple request
-        if len(splitter) == 1 and not r.is_complex():
-            logger.log("Request type: " + main_key)
-            return r
-        # Handle complex request
-        # Make sure the responder can handle complex request
-        elif len(splitter) >= 3 and r.is_complex():
-            logger.log("Request type: " + main_key)
-            a = splitter[1]             # Action
-            d = " ".join(splitter[2:])  # Detail
-            logger.log("Request action: " + a)
-            logger.log("Request detail: " + d)
-            # Make sure action is valid
-            if a in r.actions():
-                r.receive(sender.puid, a, d)
-                return r
-    return None
+    matched = router.route(sender.puid, request, sender.puid in admins)
+    if matched is not None:
+        r = matched[1]
+        logger.log("Request type: %s", r.key)
+        if r.action is not None:
+            logger.log("Request action: %s", r.action)
+        if r.detail is not None:
+            logger.log("Request detail: %s", r.detail)
+    return matched
 
 def get_users(username):
     """
-    Search for users with the given username. If the given
-    username does not exist, it will be ignored
-    Return a list of user object in wxpy as result
+    Find users with the given username and the names in username_file.
+    If the given username does not exist, it will be ignored
+    Return a Whitelist of their puid as result, None if not restrict
     """
     if restrict:
-        users = []
-        friends = bot.friends()
-        for user in username:
-            search = friends.search(user)
-            if len(search) > 0:
-                users.append(search[0])
-        if allow_self:
-            users.append(bot.self)
+        always = [transport.me().puid] if allow_self else []
+        users = Whitelist(friend_index, username, username_file, always)
+        users.refresh()
         return users
     return None
-users = get_users(username_list)
 
-def send_to_users(msg):
+def get_admins(username):
+    """
+    Find admins with the given username, return a Whitelist of their puid.
+    Yourself is always an admin
+    """
+    admins = Whitelist(friend_index, username,
+                       always=[transport.me().puid])
+    admins.refresh()
+    return admins
+
+def refresh_friends():
+    "Update friend index with the friend list, then find users and admins"
+    changed, removed = friend_index.refresh(transport.friends(update=True))
+    logger.log("Refreshed friends: %d changed, %d removed", changed, removed)
+    if users is not None:
+        users.refresh()
+    admins.refresh()
+
+def refresh_friends_loop():
+    "Refresh friends every friend_refresh seconds"
+    while True:
+        time.sleep(friend_refresh)
+        try:
+            refresh_friends()
+        except Exception as e:
+            logger.error("Failed to refresh friends: %r", e)
+
+def send_to_user(puid, msg):
+    "Send message to the user with the puid, such as a stock alert"
+    me = transport.me()
+    user = me if puid == me.puid else friend_index.get(puid)
+    if user is None:
+        raise LookupError("User not found: " + puid)
+    for message in split_messages(msg, max_reply):
+        user.send(message)
+
+def stock_price(symbol):
+    "Return (date, price) of the symbol for the stock watches"
+    return responder_map["stock"].get().latest_price(symbol)
+
+def send_to_users(msg, job_id=None, job_name=None):
     """
     Send message to users. If restrict is on, send to user_list,
     otherwise, send to all users(be careful)
+    Messages are sent by a Broadcast, at most broadcast_rate per second.
+    If the bot crashed while sending, send again with the same job_id to
+    skip the users that already received it. If job_name is given instead,
+    the last job of the name is resumed if it was interrupted, otherwise
+    it is sent to everyone again as a new job
+    Return the counters of the Broadcast
     """
     if restrict:
-        for user in users:
-            user.send(msg)
+        chats = []
+        me = transport.me()
+        for puid in users:
+            user = me if puid == me.puid else friend_index.get(puid)
+            if user is not None:
+                chats.append(user)
     else:
-        friends = bot.friends()
-        for f in friends:
-            f.send(msg)
+        chats = list(transport.friends())
+    broadcast = Broadcast(concurrency=broadcast_concurrency,
+                          rate=broadcast_rate)
+    if job_id is None and job_name is not None:
+        job_id = broadcast.job_id(job_name)
+    elif job_id is None:
+        job_id = "broadcast-" + str(int(time.time()))
+    return broadcast.run(job_id, msg, chats)
 
 
+def dispatch(msg, responder, request, trace=None, queued=None):
+    """
+    Run the responder in a worker thread and reply to the message, the
+    message handler thread is free to receive other requests meanwhile.
+    trace is the Trace of the message and queued is perf_counter() when
+    it was submitted, if the message is traced
+    """
+    with tracer.use(trace), profiler.profile(request.key):
+        if queued is not None:
+            tracer.add("queue", queued)
+        try:
+            # Lazy responds do their work while they are sent, so the
+            # request is pending and timed until the reply is sent
+            with metrics.timer(request.key, "respond"):
+                respond = responder.handle(request)
+                if respond is not None:
+                    result = send_reply(msg, respond, request.key)
+        except Exception as e:
+            logger.error("Responder %s failed: %r", request.key, e)
+            logger.span()
+            tracer.finish(trace, result="error")
+            return
+        finally:
+            admission.finish()
+        if respond is None:
+            logger.log("Not a valid request, ignored")
+            logger.span()
+            tracer.finish(trace, result="invalid")
+            return
+        tracer.finish(trace, result=result)
+
+def send_reply(msg, respond, key):
+    """
+    Reply to the message with the respond, a str or an iterable of str
+    chunks, in messages of at most max_reply characters. Return "sent",
+    "cut" or "error"
+    """
+    sent = 0
+    result = "sent"
+    try:
+        with tracer.span("send"):
+            for message in split_messages(respond, max_reply):
+                if sent == max_reply_messages:
+                    msg.reply(cut_message)
+                    result = "cut"
+                    break
+                logger.log("Respond: %s", message)
+                msg.reply(message)
+                sent += 1
+    except Exception as e:
+        logger.error("Responder %s failed: %r", key, e)
+        result = "error"
+    logger.span()
+    return result
+
+def reqeust_respond(msg):
+    "Handle the message received by the bot"
+    accepted = prefilter.accept(msg)
+    if accepted is None:
+        return
+    user, text = accepted
+    if users is not None and user.puid not in users:
+        return
+    trace = tracer.begin("message")
+    start = time.perf_counter()
+    with tracer.use(trace), profiler.profile("parse"):
+        with tracer.span("parse"):
+            matched = get_responder(user, text)
+    if matched is None:
+        metrics.observe("ignored", "parse", time.perf_counter() - start)
+        logger.log("Not a valid request, ignored")
+        logger.span()
+        tracer.finish(trace, result="ignored")
+        return
+    responder, request = matched
+    metrics.observe(request.key, "parse", time.perf_counter() - start)
+    # Only requests that parse take tokens from the rate limits
+    result, notify = admission.admit(user.puid, responder.cost)
+    if result != ADMITTED:
+        logger.warning("Request from %s %s", user, result)
+        if notify:
+            msg.reply(busy_message if result == BUSY else limited_message)
+        tracer.finish(trace, result=result)
+        return
+    logger.log("Request from: %s", user)
+    if trace is not None:
+        trace.attrs["key"] = request.key
+    executor.submit(dispatch, msg, responder, request, trace,
+                    time.perf_counter())
+
 #
 #   Bot register
 #
-logger.log("Param: go_log="+str(do_log))
-logger.log("Param: send_greet="+str(send_greet))
-logger.log("Param: send_bye="+str(send_bye))
-logger.log("Param: restrict="+str(restrict))
-logger.log("Param: allow_self="+str(allow_self))
-logger.log("Accepet users(if None, means all users)="+str(users))
-logger.log("WechatBot activated")
-# Sending welcome message
-if send_greet:
-    send_to_users(greeting)
-
-@bot.register(chats=users, msg_types=TEXT, except_self=not allow_self)
-def reqeust_respond(msg):
-    logger.log("Request from: " + str(msg.sender))
-    responder = get_responder(msg.sender, msg.text)
-    if responder is not None:
-            respond = responder.respond()
-            if respond is not None:
-                logger.log("Respond: " + respond)
-                logger.span()
-                return respond
-    logger.log("Not a valid request, ignored")
-    logger.span()
+def activate(new_transport):
+    """
+    Find users and admins on the transport, and let reqeust_respond receive
+    its messages. The transport can be a WxpyTransport for Wechat, or any
+    other Transport, such as a SimulatedTransport for testing
+    """
+    global transport, users, admins
+    logger.log("Activating WechatBot")
+    transport = new_transport
+    with startup.phase("find users"):
+        friend_index.refresh(transport.friends())
+        users = get_users(username_list)
+        admins = get_admins(admin_list)
+    with startup.phase("preload cache"):
+        response_cache.preload(cache_preload)
+    logger.log("Param: go_log=%s", do_log)
+    logger.log("Param: send_greet=%s", send_greet)
+    logger.log("Param: send_bye=%s", send_bye)
+    logger.log("Param: restrict=%s", restrict)
+    logger.log("Param: allow_self=%s", allow_self)
+    logger.log("Accepet users(if None, means all users)=%s", users)
+    # Users are checked by puid in reqeust_respond, so the whitelist can
+    # change without registering again
+    transport.listen(reqeust_respond, allow_self)
+    if friend_refresh > 0:
+        threading.Thread(target=refresh_friends_loop, daemon=True,
+                         name="FriendRefresh").start()
+    logger.log("WechatBot activated")
+    logger.log(["Startup time:"] + startup.report())
+    if stats_dump is not None:
+        metrics.start_dump(stats_dump, stats_interval)
+    if trace_file is not None:
+        tracer.start(trace_file)
+    if alert_interval > 0 and "stock" in responder_map:
+        stock_alerts.start(stock_price, send_to_user, alert_interval)
+    # Sending welcome message
+    if send_greet:
+        send_to_users(greeting, job_name="greeting")
+
+def deactivate():
+    "Finish the requests that are still running and say goodbye"
+    executor.shutdown(wait=True)
+    response_cache.flush()
+    tracer.flush()
+    # Sending goodbye message
+    if send_bye:
+        send_to_users(bye, job_name="bye")
+    logger.log("WechatBot deactivated")
+
+def main():
+    with startup.phase("login"):
+        # Allow cache, avoid scanning QR too many times
+        new_transport = WxpyTransport(cache_path=True, auto_mark=auto_mark)
+    activate(new_transport)
+    # keep thread alive
+    transport.wait()
+    deactivate()
 
-# keep thread alive
-embed()
-# Sending goodbye message
-if send_bye:
-    send_to_users(bye)
-logger.log("WechatBot deactivated")
+if __name__ == "__main__":
+    main()